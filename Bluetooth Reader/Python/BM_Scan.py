@@ -26,182 +26,86 @@ __version__ = "1.0"
 ## Added support for uploading the sample info as well.
 ##
 
-from multiprocessing.sharedctypes import Value
-from time import sleep
-from bluepy.btle import BTLEDisconnectError, Scanner, DefaultDelegate
-import urllib3
 import argparse
 import os
-import influxdb_client
-from influxdb_client.client.write_api import SYNCHRONOUS
-
-
-def byte(str, byteNum):
-    # https://stackoverflow.com/questions/5649407/hexadecimal-string-to-byte-array-in-python
-    # Trapping for 'str' passed as 'None'
-    if (str == None):
-        return ''
-
-    return str[byteNum * 2] + str[byteNum * 2 + 1]
+import signal
+import time
+try:
+    from bluepy.btle import BTLEDisconnectError, Scanner, DefaultDelegate
+except ImportError:
+    # Not needed to --replay a capture, e.g. on a laptop.
+    Scanner = None
+    DefaultDelegate = object
+    class BTLEDisconnectError(Exception):
+        pass
+from broodminder.decode import decode, is_broodminder
+from broodminder.dedup import SampleDedup
+from broodminder.metrics import PROFILER, REGISTRY
+from broodminder.pipeline import SinkPipeline
+from broodminder.reading import BroodMinderResult
+from broodminder.sinks import SINKS, Sink, is_rejected, load_sink
+# Capture/replay, multi-adapter scanning, the spool and the metrics listener are imported when they're turned on.
+
+BEACONS_SEEN = REGISTRY.counter("broodminder_beacons_seen_total", "BroodMinder advertisements received", ["device"])
+BEACONS_DECODED = REGISTRY.counter("broodminder_beacons_decoded_total", "BroodMinder advertisements successfully decoded", ["device"])
+RSSI = REGISTRY.gauge("broodminder_rssi_dbm", "Signal strength of the last advertisement from each device", ["device"])
+DECODE_SECONDS = REGISTRY.histogram("broodminder_decode_seconds", "Time taken to decode an advertisement",
+                                    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.01))
+SPOOL_DEPTH = REGISTRY.gauge("broodminder_spool_depth", "Readings waiting in the spool")
 
 
 def checkBM(data):
     check = False
-    byteCheck = 0
-    BMIFLLC = str("8d02")
-    # print(byte(data,byteCheck))
-    if (BMIFLLC == byte(data, byteCheck) + byte(data, byteCheck + 1)):
+    if (is_broodminder(data)):
         print("confirmed BroodMinder")
         check = True
     return check
 
 
 def extractData(deviceId, data):
-    offset = 8  # There are 8 bits less than described in BroodMinder documentation
-
-    byteNumAdvdeviceModelIFllc_1 = 10 - offset
-    byteNumAdvDeviceVersionMinor_1 = 11 - offset
-    byteNumAdvDeviceVersionMajor_1 = 12 - offset
-    byteNumAdvBattery_1V2 = 14 - offset
-    byteNumAdvElapsed_2 = 15 - offset   # This is the sample number from the device.
-    byteNumAdvTemperature_2 = 17 - offset
-    byteNumAdvHumidity_1 = 24 - offset
-    byteNumAdvElapsed_2V2 = 15 - offset
-    byteNumAdvTemperature_2V2 = 17 - offset
-    byteNumAdvWeightL_2V2 = 20 - offset
-    byteNumAdvWeightR_2V2 = 22 - offset
-    byteNumAdvHumidity_1V2 = 24 - offset
-    byteNumAdvUUID_3V2 = 25 - offset
-
-    # Version 2 advertising
-
-    # Current sample number from the device.
-    sampleNumber = int(byte(data, byteNumAdvElapsed_2), 16)
-
-    # batteryPercent = e.data[byteNumAdvBattery_1V2]
-    batteryPercent = int(byte(data, byteNumAdvBattery_1V2), 16)
-    # Elapsed = e.data[byteNumAdvElapsed_2V2] + (e.data[byteNumAdvElapsed_2V2 + 1] << 8)
-
-    # temperatureDegreesC = e.data[byteNumAdvTemperature_2V2] + (e.data[byteNumAdvTemperature_2V2 + 1] << 8)
-    temperatureDegreesC = int(byte(data, byteNumAdvTemperature_2V2 + 1) + byte(data, byteNumAdvTemperature_2V2), 16)
-    temperatureDegreesC = (temperatureDegreesC - 5000) / 100
-    temperatureDegreesF = round((temperatureDegreesC * 9 / 5) + 32, 1)
-
-    # humidityPercent = e.data[byteNumAdvHumidity_1V2]
-    humidityPercent = int(byte(data, byteNumAdvHumidity_1V2), 16)
-
-    # weightL = e.data[byteNumAdvWeightL_2V2+1] * 256 + e.data[byteNumAdvWeightL_2V2 + 0] - 32767
-    weightL = int(byte(data, byteNumAdvWeightL_2V2 + 1) + byte(data, byteNumAdvWeightL_2V2 + 0), 16) - 32767
-    weightScaledL = float(weightL) / 100
-    # weightR = e.data[byteNumAdvWeightR_2V2 + 1] * 256 + e.data[byteNumAdvWeightR_2V2 + 0] - 32767
-    weightR = int(byte(data, byteNumAdvWeightR_2V2 + 1) + byte(data, byteNumAdvWeightR_2V2 + 0), 16) - 32767
-    weightScaledR = float(weightR) / 100
-    weightScaledTotal = weightScaledL + weightScaledR
-
-    # If the weight is a positive number, it's good. If it's negative, we know it's a false reading.
-    # Note wildly negative readings happen on T&H devices, so we always need to trap for this.
-    if (weightScaledTotal > -1):
+    # data is the raw manufacturer specific data (dev.getValue(255)). Hex strings from getValueText(255) are still accepted.
+    if isinstance(data, str):
+        data = bytes.fromhex(data)
+
+    with DECODE_SECONDS.time():
+        adv = decode(data)
+    if adv is None:
+        return None
+    temperatureDegreesF = round((adv.TemperatureC * 9 / 5) + 32, 1)
+
+    if (adv.Weight is not None):
         # We have a valid weight.
         print(
-            "Sample = {}, Weight = {}, TemperatureF = {}, Humidity = {}, Battery = {}".format(sampleNumber, weightScaledTotal, temperatureDegreesF,
-                                                                                 humidityPercent, batteryPercent))
-        result = BroodMinderResult(deviceId, sampleNumber, temperatureDegreesC, humidityPercent, batteryPercent, weightScaledTotal)
+            "Sample = {}, Weight = {}, TemperatureF = {}, Humidity = {}, Battery = {}".format(adv.SampleNumber, adv.Weight, temperatureDegreesF,
+                                                                                 adv.HumidityPercent, adv.BatteryPercent))
     else:
         # We do not have a valid weight.
-        print("Sample = {}, TemperatureF = {}, Humidity = {}, Battery = {}".format(sampleNumber, temperatureDegreesF, humidityPercent,
-                                                                      batteryPercent))
-        result = BroodMinderResult(deviceId, sampleNumber, temperatureDegreesC, humidityPercent, batteryPercent)
-    
-    return result
+        print("Sample = {}, TemperatureF = {}, Humidity = {}, Battery = {}".format(adv.SampleNumber, temperatureDegreesF, adv.HumidityPercent,
+                                                                      adv.BatteryPercent))
+    return BroodMinderResult(deviceId, adv.SampleNumber, adv.TemperatureC, adv.HumidityPercent, adv.BatteryPercent, adv.Weight)
 
 class ScanDelegate(DefaultDelegate):
-    def __init__(self):
+    # Decodes BroodMinder advertisements as they arrive and hands them to the pipeline, so scanning never
+    # has to stop while data is being uploaded.
+    def __init__(self, pipeline: SinkPipeline, capture=None):
+        # capture: optional broodminder.capture.CaptureWriter to record every advertisement to.
         DefaultDelegate.__init__(self)
+        self.pipeline = pipeline
+        self.capture = capture
 
     def handleDiscovery(self, dev, isNewDev, isNewData):
-        if isNewDev:
-            #print("Discovered device {}".format(dev.addr))
-            pass
-        elif isNewData:
-            #print("Received new data from {}".format(dev.addr))
-            pass
-
-class BroodMinderResult:
-    def __init__(self, deviceId, sampleNumber, temperatureC, humidityPercent, batteryPercent, weight = None):
-        self.DeviceId = deviceId
-        self.SampleNumber = sampleNumber
-        self.TemperatureC = temperatureC
-        self.HumidityPercent = humidityPercent
-        self.BatteryPercent = batteryPercent
-        self.Weight = weight # TH devices don't have weight, so by default this will be None.
-        # The MyBroodMinder API expects the temperature in F :(
-        self.TemperatureF = round((temperatureC * 9 / 5) + 32, 1)
-
-def sendDataToMyBroodMinder(data: BroodMinderResult):
-    # Send the info to MyBroodMinder.com
-    print("Sending device '{}' data to the MyBroodMinder Cloud ...".format(data.DeviceId))
-    url_string = "https://mybroodminder.com/api_public/devices/upload?device_id={}&sample={}&temperature={}&humidity={}&battery_charge={}".format(
-        data.DeviceId, data.SampleNumber, data.TemperatureF, data.HumidityPercent, data.BatteryPercent)
-    if data.Weight is not None: # Not all results will have weight, so only include it if we have a value.
-        url_string += "&weight={}".format(data.Weight)
-    print(url_string)
-    # Fire off the GET request which uploads the data. This should really be POST but that's not how the API works.
-    urllib3.PoolManager().request("GET", url_string)
-
-def sendDataToInfluxDb(write_api, org: str, bucket: str, data: BroodMinderResult):
-    p = influxdb_client.Point("broodminder").tag("deviceId", data.DeviceId).field("temperature", data.TemperatureC).field(
-        "humidity", data.HumidityPercent).field("battery", data.BatteryPercent).field("sampleNumber", data.SampleNumber)
-    write_api.write(org=org, bucket=bucket, record=p)
-
-
-# program starts here
-parser = argparse.ArgumentParser()
-# In order to better support running in Docker, all arguments can be specified via env vars too.
-parser.add_argument("--daemon", help="Run in a continuous loop, scanning for new data every 60s", action="store_true")
-parser.add_argument("--output", help="Where to send the discovered data", default=os.environ.get("OUTPUT_MODE", "cloud"), choices=["cloud", "influxdb"])
-parser.add_argument("--influxdb-url", help="InfluxDB Server URL, needed if output=influxdb", default=os.environ.get("INFLUXDB_URL"))
-parser.add_argument("--influxdb-org", help="InfluxDB Organisation, needed if output=influxdb", default=os.environ.get("INFLUXDB_ORG"))
-parser.add_argument("--influxdb-bucket", help="InfluxDB Bucket, needed if output=influxdb", default=os.environ.get("INFLUXDB_BUCKET"))
-parser.add_argument("--influxdb-token", help="InfluxDB Auth Token, needed if output=influxdb", default=os.environ.get("INFLUXDB_TOKEN"))
-args = parser.parse_args()
-
-# Validate that we have all the other args we need to connect.
-output_mode = getattr(args, "output", None)
-influxdb_url = getattr(args, "influxdb_url", None)
-influxdb_org = getattr(args, "influxdb_org", None)
-influxdb_bucket = getattr(args, "influxdb_bucket", None)
-influxdb_token = getattr(args, "influxdb_token", None)
-
-if output_mode == "influxdb":
-    if influxdb_url is None:
-        raise ValueError("influxdb-url must be set with output=influxdb")
-    if influxdb_org is None:
-        raise ValueError("influxdb-org must be set with output=influxdb")
-    if influxdb_bucket is None:
-        raise ValueError("influxdb-bucket must be set with output=influxdb")
-    if influxdb_token is None:
-        raise ValueError("influxdb-token must be set with output=influxdb")
-
-client = influxdb_client.InfluxDBClient(url=influxdb_url, token=influxdb_token, org=influxdb_org)
-influxdb_write_api = client.write_api(write_options=SYNCHRONOUS)
-
-scanner = Scanner(0).withDelegate(ScanDelegate())
-
-while True:
-    devices = []
-    try:
-        devices = scanner.scan(15.0)
-    except BTLEDisconnectError:
-        # This seems to happen sometimes, presumably from devices losing connection part-way through us
-        # receiving data from them - nothing we can do about that so just ignore any occurrences of this
-        # and hopefully the next time we won't get disconnected (if it's even a device we care about).
-        pass
-
-    for dev in devices:
-        if (checkBM(dev.getValueText(255))):
+        if not (isNewDev or isNewData):
+            # Same advertisement as last time, just a new RSSI.
+            return
+
+        manufacturerData = dev.getValue(255)
+        if self.capture is not None and manufacturerData is not None:
+            self.capture.write(manufacturerData, dev.addr, dev.rssi, dev.getValueText(9))
+        if (checkBM(manufacturerData)):
             # print "BroodMinder Found!"
             # print "Device %s (%s), RSSI=%d dB" % (dev.addr, dev.addrType, dev.rssi)
             print("Device {} ({}), RSSI={} dB".format(dev.addr, dev.addrType, dev.rssi))
+            deviceId = None
             for (adtype, desc, value) in dev.getScanData():
                 # print "  %s = %s" % (desc, value)
                 print ("{} = {}".format(desc, value))
@@ -210,24 +114,241 @@ while True:
                 if (desc == "Complete Local Name"):
                     deviceId = value
             if deviceId is not None:
-                result = extractData(deviceId, dev.getValueText(255))
-                if output_mode == "cloud":
-                    sendDataToMyBroodMinder(result)
-                elif output_mode == "influxdb":
-                    sendDataToInfluxDb(influxdb_write_api, influxdb_org, influxdb_bucket, result)
-                else:
-                    raise ValueError("Unknown output mode {}, not doing anything with results.".format(output_mode))
-                print("--- Data uploaded ---")
-
+                BEACONS_SEEN.inc(device=deviceId)
+                RSSI.set(dev.rssi, device=deviceId)
+                result = extractData(deviceId, manufacturerData)
+                if result is not None:
+                    BEACONS_DECODED.inc(device=deviceId)
+                    self.pipeline.submit(result)
             else:
+                # The name arrives in the scan response, so we'll get another go at this device when that turns up.
                 print("No BM device ID found in this packet - ignoring.")
         else:
             #print("Device {} is not a broodminder - ignoring".format(dev.addr))
             pass
 
-    # If we're not running in daemon mode, break out of the loop and thus exit the program.
-    if getattr(args, "daemon") == False:
-        break
-    # If we are in daemon mode, sleep until the next run.
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    # In order to better support running in Docker, all arguments can be specified via env vars too.
+    parser.add_argument("--daemon", help="Scan continuously, sending data as soon as it is received", action="store_true")
+    parser.add_argument("--scan-window", help="In daemon mode, restart the scan every this many seconds", type=float, default=float(os.environ.get("SCAN_WINDOW", 10.0)))
+    parser.add_argument("--hci", help="Comma separated Bluetooth adapters to scan on, e.g. 0,1 for hci0 and hci1. Each one gets its own process",
+                        default=os.environ.get("HCI", "0"))
+    parser.add_argument("--merge-window", help="With several adapters, seconds to wait for other adapters to hear a sample before keeping the strongest copy",
+                        type=float, default=float(os.environ.get("MERGE_WINDOW", 2.0)))
+    parser.add_argument("--capture", help="Also record every advertisement with manufacturer data to this file, for --replay", default=os.environ.get("CAPTURE_FILE"))
+    parser.add_argument("--replay", help="Replay advertisements from a --capture file instead of scanning", default=os.environ.get("REPLAY_FILE"))
+    parser.add_argument("--replay-speed", help="Replay at this multiple of real time. 0 replays as fast as possible", type=float, default=float(os.environ.get("REPLAY_SPEED", 1.0)))
+    parser.add_argument("--replay-multiplier", help="Replay each advertisement as this many different devices", type=int, default=int(os.environ.get("REPLAY_MULTIPLIER", 1)))
+    parser.add_argument("--queue-size", help="Maximum number of readings waiting to be sent", type=int, default=int(os.environ.get("QUEUE_SIZE", 1000)))
+    parser.add_argument("--dedup-ttl", help="Seconds to remember a sample that has been sent, so it isn't sent again. 0 disables", type=float, default=float(os.environ.get("DEDUP_TTL", 6 * 3600)))
+    parser.add_argument("--dedup-max-size", help="Maximum number of samples to remember", type=int, default=int(os.environ.get("DEDUP_MAX_SIZE", 10000)))
+    parser.add_argument("--dedup-file", help="File to keep the sent samples in across restarts", default=os.environ.get("DEDUP_FILE"))
+    parser.add_argument("--output", help="Where to send the discovered data", default=os.environ.get("OUTPUT_MODE", "cloud"), choices=sorted(SINKS))
+    parser.add_argument("--cloud-url", help="MyBroodMinder upload URL, defaults to the public API", default=os.environ.get("CLOUD_URL"))
+    parser.add_argument("--cloud-concurrency", help="Maximum number of uploads to MyBroodMinder at once", type=int, default=int(os.environ.get("CLOUD_CONCURRENCY", 4)))
+    parser.add_argument("--cloud-timeout", help="Seconds to wait for MyBroodMinder to respond", type=float, default=float(os.environ.get("CLOUD_TIMEOUT", 10.0)))
+    parser.add_argument("--cloud-retries", help="Times to retry a failed upload to MyBroodMinder", type=int, default=int(os.environ.get("CLOUD_RETRIES", 3)))
+    parser.add_argument("--spool-file", help="Where to keep readings that couldn't be sent until they can be. Set to an empty string to disable",
+                        default=os.environ.get("SPOOL_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "broodminder_spool.sqlite")))
+    parser.add_argument("--spool-max-rows", help="Maximum number of readings to keep in the spool", type=int, default=int(os.environ.get("SPOOL_MAX_ROWS", 1000000)))
+    parser.add_argument("--metrics-port", help="Serve Prometheus metrics on this port at /metrics. 0 disables", type=int, default=int(os.environ.get("METRICS_PORT", 0)))
+    parser.add_argument("--profile-seconds", help="Profile for this many seconds at startup and whenever SIGUSR1 is received. 0 disables", type=float, default=float(os.environ.get("PROFILE_SECONDS", 0)))
+    parser.add_argument("--profile-output", help="Where to write the cProfile stats", default=os.environ.get("PROFILE_OUTPUT", "broodminder_scan.prof"))
+    parser.add_argument("--rollups", help="With output=influxdb, also write hourly/daily rollups to the broodminder_1h and broodminder_1d measurements", action="store_true",
+                        default=os.environ.get("ROLLUPS", "").lower() in ("1", "true", "yes"))
+    parser.add_argument("--rollup-file", help="Where to keep the rollup buckets waiting to be recomputed across restarts",
+                        default=os.environ.get("ROLLUP_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "broodminder_rollups.json")))
+    parser.add_argument("--influxdb-url", help="InfluxDB Server URL, needed if output=influxdb", default=os.environ.get("INFLUXDB_URL"))
+    parser.add_argument("--influxdb-org", help="InfluxDB Organisation, needed if output=influxdb", default=os.environ.get("INFLUXDB_ORG"))
+    parser.add_argument("--influxdb-bucket", help="InfluxDB Bucket, needed if output=influxdb", default=os.environ.get("INFLUXDB_BUCKET"))
+    parser.add_argument("--influxdb-token", help="InfluxDB Auth Token, needed if output=influxdb", default=os.environ.get("INFLUXDB_TOKEN"))
+    args = parser.parse_args()
+
+    if (args.capture or args.replay) and len([hci for hci in args.hci.split(",") if hci.strip()]) > 1:
+        raise ValueError("capture and replay only work with a single adapter")
+    if args.replay is None and Scanner is None:
+        raise ValueError("bluepy must be installed to scan, only --replay works without it")
+    # Replayed (and especially multiplied) readings would otherwise end up on real hives.
+    if args.replay and args.output == "cloud" and not args.cloud_url:
+        raise ValueError("cloud-url must be set to replay with output=cloud, e.g. to a local stand-in")
+
+    # Validate that we have all the other args we need to connect.
+    if args.output == "influxdb":
+        if args.influxdb_url is None:
+            raise ValueError("influxdb-url must be set with output=influxdb")
+        if args.influxdb_org is None:
+            raise ValueError("influxdb-org must be set with output=influxdb")
+        if args.influxdb_bucket is None:
+            raise ValueError("influxdb-bucket must be set with output=influxdb")
+        if args.influxdb_token is None:
+            raise ValueError("influxdb-token must be set with output=influxdb")
+    return args
+
+
+# Only the selected sink's module (and its client library) is imported.
+def create_sink(args, spool=None, dedup=None) -> Sink:
+    sinkClass = load_sink(args.output)
+    if args.output == "cloud":
+        # Cloud uploads fail on the uploader's threads, after the pipeline has moved on. Without a spool to keep
+        # them, forget them in the dedup index so the next copy of the sample is sent.
+        on_failure = spool.append if spool is not None else None
+        if spool is None and dedup is not None:
+            on_failure = lambda data: dedup.forget(data.DeviceId, data.SampleNumber)
+        return sinkClass.connect(args.cloud_url, concurrency=args.cloud_concurrency, timeout=args.cloud_timeout,
+                                 max_retries=args.cloud_retries, on_failure=on_failure,
+                                 on_reject=(lambda data, reason: spool.quarantine([data], reason)) if spool is not None else None)
+    return sinkClass.connect(args.influxdb_url, args.influxdb_token, args.influxdb_org, args.influxdb_bucket,
+                             rollups=args.rollups, rollup_path=args.rollup_file or None)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def main():
+    args = parse_args()
+    adapters = [int(hci.strip().replace("hci", "")) for hci in args.hci.split(",") if hci.strip()]
+
+    if args.metrics_port:
+        from broodminder.metrics import start_http_server
+        start_http_server(args.metrics_port)
+        print("Serving metrics on port {}".format(args.metrics_port))
+    if args.profile_seconds > 0:
+        PROFILER.start(args.profile_seconds, args.profile_output)
+        PROFILER.start_on_signal(signal.SIGUSR1, args.profile_seconds, args.profile_output)
+
+    spool = None
+    if args.spool_file:
+        from broodminder.spool import ReadingSpool
+        spool = ReadingSpool(args.spool_file, BroodMinderResult, max_rows=args.spool_max_rows)
+        SPOOL_DEPTH.set_function(spool.__len__)
+        if len(spool) > 0:
+            print("{} readings waiting in the spool from last time".format(len(spool)))
+
+    dedup = None
+    if args.dedup_ttl > 0:
+        dedup = SampleDedup(ttl=args.dedup_ttl, max_size=args.dedup_max_size, path=args.dedup_file or None)
+
+    sink = create_sink(args, spool, dedup)
+    cloud_uploader = getattr(sink, "uploader", None)
+
+    def sendData(result: BroodMinderResult):
+        if spool is not None and len(spool) > 0:
+            # There's already a backlog, so the sink is probably down. Queue behind it and let the drainer
+            # send everything in bulk once it's back.
+            spool.append(result)
+            return
+        if args.output == "cloud":
+            print("Sending device '{}' data to the MyBroodMinder Cloud ...".format(result.DeviceId))
+        try:
+            sink.send(result)
+        except Exception as e:
+            if spool is None:
+                raise
+            if is_rejected(e):
+                # Sending it again won't help, so keep it out of the way of the readings that will go through.
+                spool.quarantine([result], str(e))
+                return
+            # Keep it for the drainer to send once the sink is reachable again.
+            print("Couldn't send data for device '{}', spooling it: {}".format(result.DeviceId, e))
+            spool.append(result)
+            return
+        print("--- Data uploaded ---")
+
+    drainer = None
+    if spool is not None:
+        from broodminder.spool import SpoolDrainer
+        drainer = SpoolDrainer(spool, sink).start()
+
+    pipeline = SinkPipeline(sendData, max_queued=args.queue_size, dedup=dedup).start()
+    window = args.scan_window if args.daemon else 15.0
+
+    def mergedReading(deviceId, sample, temperatureC, humidity, battery, weight, timestamp, rssi):
+        BEACONS_DECODED.inc(device=deviceId)
+        RSSI.set(rssi, device=deviceId)
+        pipeline.submit(BroodMinderResult(deviceId, sample, temperatureC, humidity, battery, weight, timestamp))
+
+    multiScanner = None
+    capture = None
+    if len(adapters) > 1:
+        # Each adapter scans in its own process; we just wait here and report.
+        from broodminder.multiscan import MultiAdapterScanner
+        multiScanner = MultiAdapterScanner(adapters, mergedReading, window=window, hold=args.merge_window).start()
+        print("Scanning on {}".format(", ".join("hci{}".format(hci) for hci in adapters)))
     else:
-        sleep(60)
+        if args.capture:
+            from broodminder.capture import CaptureWriter
+            capture = CaptureWriter(args.capture)
+        if args.replay:
+            from broodminder.capture import ReplayScanner
+            scanner = ReplayScanner(args.replay, speed=args.replay_speed, multiplier=args.replay_multiplier)
+            scanner.withDelegate(ScanDelegate(pipeline, capture))
+        else:
+            scanner = Scanner(adapters[0] if adapters else 0).withDelegate(ScanDelegate(pipeline, capture))
+
+    # Docker stops containers with SIGTERM; handle it like Ctrl-C so the capture is closed and queued readings are sent.
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        while True:
+            if multiScanner is not None:
+                time.sleep(window)
+                stats = multiScanner.stats()
+                print("Adapters: {} readings received, {} merged, scanning on {}".format(
+                    stats["received"], stats["merged"], ", ".join("hci{}".format(hci) for hci in stats["alive"]) or "nothing"))
+            else:
+                try:
+                    # Results are handled by ScanDelegate as they arrive. The scan is restarted every scan-window seconds so that
+                    # the device list is cleared and controllers that filter duplicate advertisements report each device again.
+                    with PROFILER.section("scan"):
+                        scanner.scan(window)
+                except BTLEDisconnectError:
+                    # This seems to happen sometimes, presumably from devices losing connection part-way through us
+                    # receiving data from them - nothing we can do about that so just ignore any occurrences of this
+                    # and hopefully the next time we won't get disconnected (if it's even a device we care about).
+                    pass
+
+            if dedup is not None:
+                stats = dedup.stats()
+                print("Skipped {} of {} readings ({:.0%}) as already sent".format(stats["skipped"], stats["checked"], stats["skip_rate"]))
+            if cloud_uploader is not None:
+                stats = cloud_uploader.stats()
+                print("MyBroodMinder uploads: {} sent, {} failed, {} retries, {:.3f}s average / {:.3f}s max latency".format(
+                    stats["sent"], stats["failed"], stats["retries"], stats["latency_avg"], stats["latency_max"]))
+
+            if args.replay:
+                stats = scanner.stats()
+                print("Replayed {} advertisements in {:.1f}s ({:.0f}/s)".format(stats["replayed"], stats["seconds"], stats["per_sec"]))
+                if scanner.finished:
+                    break
+
+            # If we're not running in daemon mode, break out of the loop and thus exit the program. A replay runs to the end.
+            if not args.daemon and not args.replay:
+                break
+
+            if capture is not None:
+                # So a crash or a kill -9 loses at most one scan window of the capture.
+                capture.flush()
+    except KeyboardInterrupt:
+        print("Stopping ...")
+    finally:
+        if capture is not None:
+            capture.close()
+            print("Captured {} advertisements to {}".format(capture.frames, args.capture))
+
+    # Wait for everything we've found to be sent before exiting. Anything still in the spool will be sent next time.
+    if multiScanner is not None:
+        multiScanner.stop(timeout=window + 5)
+    pipeline.close()
+    if drainer is not None:
+        drainer.stop()
+    sink.close()
+    if spool is not None:
+        spool.close()
+    if dedup is not None:
+        dedup.close()
+
+
+if __name__ == "__main__":
+    main()
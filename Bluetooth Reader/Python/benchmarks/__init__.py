@@ -0,0 +1,2 @@
+# Performance benchmarks. Run from the "Bluetooth Reader/Python" directory with:
+#   python3 -m benchmarks.run_benchmarks --help
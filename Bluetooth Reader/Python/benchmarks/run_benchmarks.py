@@ -0,0 +1,248 @@
+#
+# Reproducible performance benchmarks for the scanner and the import server.
+#
+#   decode  - advertisement decode throughput: BM_Scan's extractData() and ScanDelegate.handleDiscovery() per
+#             beacon, plus the bare decoder and the NumPy batch decoder
+#   import  - rows/sec and peak memory of handle_uploaded_file() against a synthetic phone database
+#   e2e     - latency from a beacon reaching ScanDelegate.handleDiscovery() to it arriving at the (stand-in)
+#             MyBroodMinder API
+#
+# The scanner paths are driven with ReplayEntry objects, the same stand-in for bluepy's ScanEntry that --replay
+# uses, with stdout redirected to /dev/null so the scanner's per-beacon prints cost what they cost in a service.
+#
+# Everything runs locally: InfluxDB and MyBroodMinder are replaced by the HTTP stand-ins in standins.py, so no
+# Bluetooth hardware or network is needed. Each run appends one JSON object to the results file so runs can be
+# compared over time. Benchmarks whose dependencies aren't installed are recorded as skipped.
+#
+# Usage (from the "Bluetooth Reader/Python" directory):
+#   python3 -m benchmarks.run_benchmarks [--only decode import e2e] [--output benchmark_results.jsonl]
+#
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import synth
+from benchmarks.standins import FakeInfluxDB, FakeMyBroodMinder
+from broodminder.capture import KIND_ADVERTISEMENT, Frame, ReplayEntry
+from broodminder.decode import decode
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds > 0 else None
+
+
+def _entries(advertisements) -> list:
+    # The advertisements as bluepy would hand them to the scan delegate.
+    return [ReplayEntry(Frame(0.0, KIND_ADVERTISEMENT, "c0:" + deviceId + ":00:00", -60, deviceId, data))
+            for deviceId, data in advertisements]
+
+
+class _Collector:
+    # Stands in for the SinkPipeline when only the delegate is being timed.
+    def __init__(self):
+        self.results = []
+
+    def submit(self, result):
+        self.results.append(result)
+
+
+def bench_decode(args) -> dict:
+    from BM_Scan import ScanDelegate, extractData
+
+    advertisements = synth.make_advertisements(args.decode_count, devices=args.devices)
+    results = {"advertisements": len(advertisements)}
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for deviceId, data in advertisements:
+            extractData(deviceId, data)
+        results["extract_data_per_sec"] = _rate(len(advertisements), time.perf_counter() - started)
+
+        # extractData() still accepts the hex strings from bluepy's getValueText(255).
+        hexStrings = [(deviceId, data.hex()) for deviceId, data in advertisements]
+        started = time.perf_counter()
+        for deviceId, data in hexStrings:
+            extractData(deviceId, data)
+        results["extract_data_hex_per_sec"] = _rate(len(hexStrings), time.perf_counter() - started)
+
+        # Everything the scanner does per beacon before it's queued for upload.
+        entries = _entries(advertisements)
+        delegate = ScanDelegate(_Collector())
+        started = time.perf_counter()
+        for entry in entries:
+            delegate.handleDiscovery(entry, True, True)
+        results["handle_discovery_per_sec"] = _rate(len(entries), time.perf_counter() - started)
+
+    # The decoder on its own, to show how much of the above is decoding.
+    started = time.perf_counter()
+    for _, data in advertisements:
+        decode(data)
+    results["decode_per_sec"] = _rate(len(advertisements), time.perf_counter() - started)
+
+    try:
+        from broodminder.decode import decode_batch
+        frames = synth.pack_frames(advertisements)
+        # The first call imports NumPy, which isn't what we're measuring.
+        decode_batch(frames[:20 * 100], stride=20)
+        started = time.perf_counter()
+        decode_batch(frames, stride=20)
+        results["decode_batch_per_sec"] = _rate(len(advertisements), time.perf_counter() - started)
+    except ImportError as e:
+        results["decode_batch_skipped"] = str(e)
+    return results
+
+
+def bench_import(args) -> dict:
+    import influxdb_client
+    from influxdb_client.client.write_api import SYNCHRONOUS
+    from broodminder.jobs import Job
+    from sqlite_to_influxdb import BroodMinderInfluxClient, handle_uploaded_file
+
+    workdir = tempfile.mkdtemp(prefix="broodminder_bench_")
+    influx = FakeInfluxDB(delay=args.influx_delay).start()
+    try:
+        template = os.path.join(workdir, "phone.sqlite")
+        rows = synth.make_phone_db(template, devices=args.devices, readings_per_device=args.rows_per_device)
+        client = influxdb_client.InfluxDBClient(url=influx.url, token="bench", org="bench")
+        write_api = client.write_api(write_options=SYNCHRONOUS)
+
+        def run_once():
+            # handle_uploaded_file deletes the file when it's done, so give it a copy.
+            path = os.path.join(workdir, "upload.sqlite")
+            shutil.copyfile(template, path)
+            bmClient = BroodMinderInfluxClient(write_api, client.query_api(), "bench", "bench")
+            started = time.perf_counter()
+            result = handle_uploaded_file(Job(()), path, bmClient, None)
+            return time.perf_counter() - started, result
+
+        seconds, result = run_once()
+        writes, queries = influx.writes, influx.queries
+        tracemalloc.start()
+        run_once()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        client.close()
+
+        return {
+            "rows": rows,
+            "devices": args.devices,
+            "db_bytes": os.path.getsize(template),
+            "seconds": round(seconds, 3),
+            "rows_per_sec": _rate(rows, seconds),
+            "influx_writes": writes,
+            "influx_queries": queries,
+            "python_peak_bytes": peak,
+            "writer_stats": result.get("stats"),
+        }
+    finally:
+        influx.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_e2e(args) -> dict:
+    from BM_Scan import ScanDelegate
+    from broodminder.cloud import CloudUploader
+    from broodminder.pipeline import SinkPipeline
+    from broodminder.sinks.cloud import CloudSink
+
+    cloud = FakeMyBroodMinder(delay=args.cloud_delay).start()
+    uploader = CloudUploader(cloud.upload_url, concurrency=args.cloud_concurrency)
+    sink = CloudSink(uploader)
+    pipeline = SinkPipeline(sink.send, max_queued=args.e2e_count).start()
+    delegate = ScanDelegate(pipeline)
+    try:
+        advertisements = synth.make_advertisements(args.e2e_count, devices=args.devices)
+        entries = _entries(advertisements)
+        # What the stand-in will see each reading as, worked out before the clock starts.
+        keys = [(deviceId, decode(data).SampleNumber) for deviceId, data in advertisements]
+        submitted = {}
+        interval = 1.0 / args.e2e_rate
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            started = time.monotonic()
+            for n, (key, entry) in enumerate(zip(keys, entries)):
+                # Pace the beacons like a busy apiary would deliver them.
+                delay = started + n * interval - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                submitted[key] = time.monotonic()
+                delegate.handleDiscovery(entry, True, True)
+            pipeline.close()
+            sink.close()
+            elapsed = time.monotonic() - started
+
+        latencies = sorted(cloud.arrivals[k] - t for k, t in submitted.items() if k in cloud.arrivals)
+        if not latencies:
+            return {"readings": len(advertisements), "delivered": 0}
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {
+            "readings": len(advertisements),
+            "delivered": len(latencies),
+            "offered_rate": args.e2e_rate,
+            "throughput_per_sec": _rate(len(latencies), elapsed),
+            "latency_p50": round(quantiles[49], 4),
+            "latency_p95": round(quantiles[94], 4),
+            "latency_p99": round(quantiles[98], 4),
+            "latency_max": round(latencies[-1], 4),
+            "dropped": pipeline.dropped,
+        }
+    finally:
+        cloud.stop()
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "import": bench_import,
+    "e2e": bench_e2e,
+}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", help="Benchmarks to run", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--output", help="File to append the results to (JSON lines)", default="benchmark_results.jsonl")
+    parser.add_argument("--devices", help="Number of synthetic devices", type=int, default=60)
+    parser.add_argument("--decode-count", help="Advertisements to decode", type=int, default=200000)
+    parser.add_argument("--rows-per-device", help="Readings per device in the synthetic phone DB", type=int, default=2000)
+    parser.add_argument("--influx-delay", help="Seconds the InfluxDB stand-in waits before answering", type=float, default=0.0)
+    parser.add_argument("--e2e-count", help="Readings to push through the scan-to-sink pipeline", type=int, default=2000)
+    parser.add_argument("--e2e-rate", help="Readings per second offered to the pipeline", type=float, default=500.0)
+    parser.add_argument("--cloud-delay", help="Seconds the MyBroodMinder stand-in waits before answering", type=float, default=0.005)
+    parser.add_argument("--cloud-concurrency", help="Concurrent uploads to the MyBroodMinder stand-in", type=int, default=4)
+    args = parser.parse_args()
+
+    run = {
+        "timestamp": time.time(),
+        "git": _git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "results": {},
+    }
+    for name in args.only:
+        print("Running {} benchmark ...".format(name))
+        try:
+            run["results"][name] = BENCHMARKS[name](args)
+        except ImportError as e:
+            run["results"][name] = {"skipped": str(e)}
+        print(json.dumps(run["results"][name], indent=2))
+
+    with open(args.output, "a") as f:
+        f.write(json.dumps(run) + "\n")
+    print("Results appended to {}".format(args.output))
@@ -0,0 +1,112 @@
+#
+# Local HTTP stand-ins for InfluxDB and the MyBroodMinder cloud, so the benchmarks need no network.
+#
+# Both run a ThreadingHTTPServer on 127.0.0.1 on a free port, count what they receive and can add an
+# artificial response delay to mimic a slow uplink.
+#
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import gzip
+import threading
+import time
+
+
+class _StandIn:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.lock = threading.Lock()
+        standIn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and body go out in separate writes; with Nagle's algorithm on, the body then waits for
+            # the client's delayed ACK and every keep-alive request takes an extra ~40ms.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                standIn._handle(self, "GET")
+
+            def do_POST(self):
+                standIn._handle(self, "POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, request, method):
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        if request.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        if self.delay:
+            time.sleep(self.delay)
+        status, content_type, reply = self.respond(method, urlparse(request.path), body)
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(reply)))
+        request.end_headers()
+        request.wfile.write(reply)
+
+    def respond(self, method, url, body):
+        raise NotImplementedError()
+
+
+class FakeInfluxDB(_StandIn):
+    # Accepts /api/v2/write and answers every /api/v2/query with an empty result.
+    def __init__(self, delay=0.0):
+        super().__init__(delay)
+        self.writes = 0
+        self.lines = 0
+        self.queries = 0
+
+    def respond(self, method, url, body):
+        if url.path == "/api/v2/write":
+            with self.lock:
+                self.writes += 1
+                self.lines += body.count(b"\n") + 1 if body else 0
+            return 204, "text/plain", b""
+        if url.path == "/api/v2/query":
+            with self.lock:
+                self.queries += 1
+            return 200, "text/csv; charset=utf-8", b"\r\n"
+        if url.path in ("/ping", "/health"):
+            return 200, "application/json", b'{"status": "pass"}'
+        return 404, "text/plain", b"not found"
+
+
+class FakeMyBroodMinder(_StandIn):
+    # Accepts /api_public/devices/upload and notes when each (device_id, sample) arrived.
+    def __init__(self, delay=0.0):
+        super().__init__(delay)
+        self.uploads = 0
+        self.arrivals = {}
+
+    @property
+    def upload_url(self) -> str:
+        return self.url + "/api_public/devices/upload"
+
+    def respond(self, method, url, body):
+        if url.path != "/api_public/devices/upload":
+            return 404, "text/plain", b"not found"
+        query = parse_qs(url.query)
+        key = (query.get("device_id", [None])[0], int(query.get("sample", ["-1"])[0]))
+        with self.lock:
+            self.uploads += 1
+            self.arrivals[key] = time.monotonic()
+        return 200, "application/json", b'{"status": "ok"}'
@@ -0,0 +1,66 @@
+#
+# Synthetic BroodMinder data for the benchmarks: advertisements as bluepy would hand them to BM_Scan.py,
+# and phone sqlite databases like the ones uploaded to sqlite_to_influxdb.py.
+#
+
+import random
+import sqlite3
+import struct
+
+from broodminder.decode import ADV_V2, BM_MANUFACTURER_PREFIX
+
+MODEL_TH = 41     # Temperature & humidity
+MODEL_SCALE = 43  # Weight
+
+
+def device_id(index: int, model: int = MODEL_TH) -> str:
+    return "{:02x}:{:02x}:{:02x}".format(model, (index >> 8) & 0xFF, index & 0xFF)
+
+
+def make_advertisement(sample: int, model: int = MODEL_TH, rng: random.Random = random) -> bytes:
+    # Version 2 manufacturer data, plus the 3 byte UUID that follows it on real devices.
+    temperature = int(rng.uniform(5, 38) * 100) + 5000
+    if model == MODEL_SCALE:
+        weightL = 32767 + int(rng.uniform(10, 50) * 100)
+        weightR = 32767 + int(rng.uniform(10, 50) * 100)
+    else:
+        # T&H devices report nonsense weights that decode as wildly negative.
+        weightL = weightR = 0
+    return ADV_V2.pack(BM_MANUFACTURER_PREFIX, model, 10, 2, rng.randint(20, 100), sample & 0xFFFF, temperature,
+                       weightL, weightR, rng.randint(20, 90)) + bytes(rng.getrandbits(8) for _ in range(3))
+
+
+def make_advertisements(count: int, devices: int = 100, scale_fraction: float = 0.25, seed: int = 1):
+    # Returns [(deviceId, manufacturer data)], cycling through the devices with increasing sample numbers.
+    rng = random.Random(seed)
+    models = [MODEL_SCALE if rng.random() < scale_fraction else MODEL_TH for _ in range(devices)]
+    return [(device_id(i % devices, models[i % devices]), make_advertisement(i // devices, models[i % devices], rng))
+            for i in range(count)]
+
+
+def make_phone_db(path: str, devices: int = 10, readings_per_device: int = 10000, start: int = 1600000000,
+                  interval: int = 3600, seed: int = 1):
+    # Builds a StoredSensorReading table like the phone app's, with readings interleaved across devices in time
+    # order and no index on (DeviceId, Timestamp), just like the real thing.
+    rng = random.Random(seed)
+    db = sqlite3.connect(path)
+    db.execute("DROP TABLE IF EXISTS StoredSensorReading")
+    db.execute("CREATE TABLE StoredSensorReading (Id INTEGER PRIMARY KEY, DeviceId TEXT, Sample INTEGER, Timestamp INTEGER, "
+               "Temperature REAL, Humidity INTEGER, Battery INTEGER)")
+
+    def rows():
+        for n in range(readings_per_device):
+            for d in range(devices):
+                yield (device_id(d), n & 0xFFFF, start + n * interval + d, round(rng.uniform(40, 100), 1),
+                       rng.randint(20, 90), rng.randint(20, 100))
+
+    db.executemany("INSERT INTO StoredSensorReading (DeviceId, Sample, Timestamp, Temperature, Humidity, Battery) "
+                   "VALUES (?, ?, ?, ?, ?, ?)", rows())
+    db.commit()
+    db.close()
+    return devices * readings_per_device
+
+
+def pack_frames(advertisements) -> bytes:
+    # Manufacturer data only, as a flat buffer of fixed size records for decode_batch().
+    return b"".join(struct.pack("20s", data) for _, data in advertisements)
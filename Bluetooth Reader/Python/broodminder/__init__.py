@@ -0,0 +1,2 @@
+# Shared code for the BroodMinder scanner (BM_Scan.py, scanner.py) and the
+# sqlite -> InfluxDB import server (sqlite_to_influxdb.py).
@@ -0,0 +1,185 @@
+#
+# Capture raw advertisements to a file and replay them later without any Bluetooth hardware.
+#
+# The capture file is an 8 byte header (CAPTURE_MAGIC) followed by one record per advertisement:
+#
+#   timestamp (float64) | kind (uint8) | address (6 bytes) | rssi (int8) | name length (uint8) | data length (uint8)
+#   | local name (utf-8) | data
+#
+# all little-endian: 46 bytes for a typical BroodMinder advertisement (18 byte header, 8 byte name, 20 bytes of data). `kind` is KIND_ADVERTISEMENT for bluepy
+# scan results, where data is the manufacturer specific data, or KIND_BGAPI for raw BlueGiga frames.
+#
+# ReplayScanner stands in for bluepy's Scanner and ReplayBlueGigaClient for bgapi's BlueGigaClient. Both
+# replay either in real time (speed=1), faster or slower (speed=N), or as fast as possible (speed=0). With
+# multiplier=N each advertisement is replayed as N different devices, to simulate a much bigger apiary.
+#
+
+from collections import namedtuple
+import struct
+import time
+
+CAPTURE_MAGIC = b"BMCAP\x00\x01\x00"
+RECORD_HEADER = struct.Struct("<dB6sbBB")
+
+KIND_ADVERTISEMENT = 0
+KIND_BGAPI = 1
+
+COMPLETE_LOCAL_NAME = 9
+MANUFACTURER = 255
+
+Frame = namedtuple("Frame", ["Timestamp", "Kind", "Address", "Rssi", "Name", "Data"])
+
+
+def _address_bytes(address) -> bytes:
+    # "aa:bb:cc:dd:ee:ff" or 6 raw bytes.
+    if isinstance(address, str):
+        return bytes.fromhex(address.replace(":", ""))
+    return bytes(address or b"\x00" * 6)
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_MAGIC)
+        self.frames = 0
+
+    def write(self, data, address=None, rssi=0, name=None, kind=KIND_ADVERTISEMENT, timestamp=None):
+        name = (name or "").encode("utf-8")[:255]
+        data = bytes(data or b"")[:255]
+        self.file.write(RECORD_HEADER.pack(timestamp if timestamp is not None else time.time(), kind, _address_bytes(address),
+                                           max(-128, min(127, int(rssi))), len(name), len(data)))
+        self.file.write(name)
+        self.file.write(data)
+        self.frames += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    # Yields a Frame for each record in a capture file, reading it as it goes. Address is returned as
+    # "aa:bb:cc:dd:ee:ff".
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError("{} is not a BroodMinder capture file".format(path))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, kind, address, rssi, nameLength, dataLength = RECORD_HEADER.unpack(header)
+            body = f.read(nameLength + dataLength)
+            if len(body) < nameLength + dataLength:
+                return  # Capture was cut off part-way through a record.
+            yield Frame(timestamp, kind, address.hex(":"), rssi, body[:nameLength].decode("utf-8", "replace"), body[nameLength:])
+
+
+def multiply(frame: Frame, copy: int) -> Frame:
+    # The same advertisement from a different, made-up device. Copy 0 is the original. The name (which BM_Scan uses
+    # as the device ID) gets a "-<copy>" suffix, which needs no escaping in a URL or line protocol.
+    if copy == 0:
+        return frame
+    address = bytearray(bytes.fromhex(frame.Address.replace(":", "")))
+    address[0:2] = (address[0] ^ (copy >> 8 & 0xFF), address[1] ^ (copy & 0xFF))
+    return frame._replace(Address=address.hex(":"), Name="{}-{}".format(frame.Name, copy) if frame.Name else frame.Name)
+
+
+class _Replay:
+    def __init__(self, path, kind, speed=1.0, multiplier=1):
+        self.source = (f for f in read_capture(path) if f.Kind == kind)
+        self.next = next(self.source, None)
+        self.speed = speed
+        self.multiplier = max(1, int(multiplier))
+        self.replayed = 0
+        self.started = None
+        self.firstTimestamp = self.next.Timestamp if self.next is not None else 0
+
+    @property
+    def finished(self) -> bool:
+        return self.next is None
+
+    def stats(self) -> dict:
+        seconds = time.monotonic() - self.started if self.started is not None else 0.0
+        return {"replayed": self.replayed, "seconds": seconds, "per_sec": self.replayed / seconds if seconds > 0 else 0.0}
+
+    def _take(self, timeout):
+        # Yields the frames (times the multiplier) due within the next `timeout` seconds, sleeping in real time mode.
+        if self.started is None:
+            self.started = time.monotonic()
+        deadline = time.monotonic() + timeout
+        while not self.finished and time.monotonic() < deadline:
+            frame = self.next
+            if self.speed > 0:
+                due = self.started + (frame.Timestamp - self.firstTimestamp) / self.speed
+                wait = due - time.monotonic()
+                if wait > 0:
+                    if due > deadline:
+                        time.sleep(max(0.0, deadline - time.monotonic()))
+                        return
+                    time.sleep(wait)
+            self.next = next(self.source, None)
+            for copy in range(self.multiplier):
+                self.replayed += 1
+                yield multiply(frame, copy)
+
+
+class ReplayEntry:
+    # Looks enough like a bluepy ScanEntry for the scan delegates.
+    def __init__(self, frame: Frame):
+        self.addr = frame.Address
+        self.addrType = "public"
+        self.rssi = frame.Rssi
+        self.frame = frame
+
+    def getValue(self, adtype):
+        if adtype == MANUFACTURER:
+            return self.frame.Data
+        if adtype == COMPLETE_LOCAL_NAME:
+            return self.frame.Name or None
+        return None
+
+    def getValueText(self, adtype):
+        if adtype == MANUFACTURER:
+            return self.frame.Data.hex()
+        return self.getValue(adtype)
+
+    def getScanData(self):
+        scanData = []
+        if self.frame.Name:
+            scanData.append((COMPLETE_LOCAL_NAME, "Complete Local Name", self.frame.Name))
+        scanData.append((MANUFACTURER, "Manufacturer", self.frame.Data.hex()))
+        return scanData
+
+
+class ReplayScanner(_Replay):
+    # Drop-in for bluepy.btle.Scanner: scan(timeout) hands the captured advertisements to the delegate.
+    def __init__(self, path, speed=1.0, multiplier=1):
+        super().__init__(path, KIND_ADVERTISEMENT, speed, multiplier)
+        self.delegate = None
+
+    def withDelegate(self, delegate):
+        self.delegate = delegate
+        return self
+
+    def scan(self, timeout=10.0):
+        for frame in self._take(timeout):
+            self.delegate.handleDiscovery(ReplayEntry(frame), True, True)
+
+
+class ReplayResponse:
+    def __init__(self, frame: Frame):
+        self.data = frame.Data
+
+
+class ReplayBlueGigaClient(_Replay):
+    # Drop-in for bgapi's BlueGigaClient as used by scanner.py.
+    def __init__(self, path, speed=1.0, multiplier=1):
+        super().__init__(path, KIND_BGAPI, speed, multiplier)
+
+    def reset_ble_state(self):
+        pass
+
+    def scan_all(self, timeout=6):
+        return [ReplayResponse(frame) for frame in self._take(timeout)]
@@ -0,0 +1,148 @@
+#
+# Uploads readings to the MyBroodMinder cloud.
+#
+# All uploads share one urllib3 connection pool, so the TCP/TLS handshake is paid once rather than per
+# reading, and run on a small thread pool so that one slow response doesn't hold up every other hive.
+# Failed uploads are retried with jittered exponential backoff.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from urllib.parse import urlencode
+import urllib3
+
+from broodminder.metrics import FAILURES, RETRIES, WRITE_SECONDS
+from broodminder.retry import retry
+
+UPLOAD_URL = "https://mybroodminder.com/api_public/devices/upload"
+
+
+def upload_url(data, base_url=UPLOAD_URL) -> str:
+    params = {"device_id": data.DeviceId, "sample": data.SampleNumber, "temperature": data.TemperatureF,
+              "humidity": data.HumidityPercent, "battery_charge": data.BatteryPercent}
+    if data.Weight is not None: # Not all results will have weight, so only include it if we have a value.
+        params["weight"] = data.Weight
+    return "{}?{}".format(base_url, urlencode(params))
+
+
+class CloudUploadError(Exception):
+    def __init__(self, message, permanent=False):
+        # permanent: MyBroodMinder refused the reading (a 4xx other than 429), so sending it again won't help.
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class CloudUploader:
+    def __init__(self, base_url=UPLOAD_URL, concurrency=4, timeout=10.0, max_retries=3, retry_interval=1.0,
+                 max_pending=None, on_failure=None, on_reject=None):
+        # on_failure(data) is called for readings that still couldn't be uploaded after all the retries, and
+        # on_reject(data, reason) for readings MyBroodMinder refused outright, which are never retried.
+        self.on_reject = on_reject
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.on_failure = on_failure
+        self.http = urllib3.PoolManager(maxsize=concurrency, timeout=urllib3.Timeout(total=timeout), retries=False)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="cloud-upload")
+        # Once this many uploads are queued up, submit() blocks rather than buffering without limit.
+        self.pending = threading.BoundedSemaphore(max_pending or concurrency * 4)
+
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def submit(self, data):
+        self.pending.acquire()
+        try:
+            self.executor.submit(self._upload, data)
+        except Exception:
+            self.pending.release()
+            raise
+
+    def upload(self, data):
+        # Upload one reading on the calling thread, retrying as needed. Raises CloudUploadError if it can't be sent.
+        url = upload_url(data, self.base_url)
+        try:
+            retry(lambda: self._request(data, url), self.max_retries, self.retry_interval,
+                  retryable=lambda e: isinstance(e, CloudUploadError) and not e.permanent, on_retry=self._retried)
+        except CloudUploadError:
+            with self.lock:
+                self.failed += 1
+            FAILURES.inc(sink="cloud")
+            raise
+
+    def upload_many(self, readings) -> tuple:
+        # Upload a batch concurrently and wait for it to finish. Returns (readings that couldn't be sent and are
+        # worth retrying, readings that were rejected).
+        futures = [(data, self.executor.submit(self.upload, data)) for data in readings]
+        failed = []
+        rejected = []
+        for data, future in futures:
+            try:
+                future.result()
+            except CloudUploadError as e:
+                (rejected if e.permanent else failed).append(data)
+        return failed, rejected
+
+    def stats(self) -> dict:
+        with self.lock:
+            attempts = self.sent + self.failed + self.retries
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "latency_avg": self.latency_total / attempts if attempts else 0.0,
+                "latency_max": self.latency_max,
+            }
+
+    def close(self):
+        # Wait for queued uploads to finish.
+        self.executor.shutdown(wait=True)
+        self.http.clear()
+
+    def _request(self, data, url):
+        # One attempt at an upload. Raises CloudUploadError, permanent if MyBroodMinder refused the reading.
+        started = time.monotonic()
+        try:
+            # Fire off the GET request which uploads the data. This should really be POST but that's not how the API works.
+            response = self.http.request("GET", url)
+            error = None
+            if response.status >= 400:
+                error = "HTTP {}".format(response.status)
+        except urllib3.exceptions.HTTPError as e:
+            response = None
+            error = str(e)
+        elapsed = time.monotonic() - started
+        WRITE_SECONDS.observe(elapsed, sink="cloud")
+
+        with self.lock:
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+            if error is None:
+                self.sent += 1
+                return
+        # Client errors (other than rate limiting) won't get better by trying again.
+        retryable = response is None or response.status >= 500 or response.status == 429
+        raise CloudUploadError("Upload for device '{}' failed: {}".format(data.DeviceId, error), permanent=not retryable)
+
+    def _retried(self, e):
+        with self.lock:
+            self.retries += 1
+        RETRIES.inc(component="cloud")
+
+    def _upload(self, data):
+        try:
+            self.upload(data)
+        except CloudUploadError as e:
+            print(e)
+            if e.permanent:
+                if self.on_reject is not None:
+                    self.on_reject(data, str(e))
+            elif self.on_failure is not None:
+                self.on_failure(data)
+        finally:
+            self.pending.release()
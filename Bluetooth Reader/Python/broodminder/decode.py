@@ -0,0 +1,156 @@
+#
+# Decoders for the BroodMinder BLE advertisement.
+#
+# Everything here works on the raw bytes of the advertisement (bytes, bytearray or memoryview) using
+# precompiled struct layouts, so there is no hex string slicing on the hot path. There is also a NumPy
+# path (decode_batch) which decodes a whole array of captured advertisements in one vectorised pass.
+#
+# Byte offsets in the BroodMinder documentation are relative to the start of the advertising frame.
+# bluepy hands us just the manufacturer specific data (AD type 255), which starts 8 bytes later with the
+# BroodMinder company ID (0x028D, little endian). The BlueGiga client used by scanner.py hands us the
+# whole frame, so it has its own layout.
+#
+
+from collections import namedtuple
+import struct
+
+BM_MANUFACTURER_PREFIX = b"\x8d\x02"  # Company ID 0x028D, little endian.
+
+# Manufacturer data layouts (offset 0 == documentation byte 8):
+#   0-1 company ID, 2 model, 3 version minor, 4 version major, 5 unused, 6 battery %,
+#   7-8 elapsed (sample number), 9-10 temperature, 11 unused, 12-13 weight L, 14-15 weight R, 16 humidity
+# Version 1 devices report the raw SHT temperature and have no weight.
+ADV_V1 = struct.Struct("<2sBBBxBHH5xB")
+ADV_V2 = struct.Struct("<2sBBBxBHHxHHB")
+ADV_LENGTH = ADV_V2.size
+
+# Full BlueGiga advertising frame, as read by scanner.py (documentation offsets, offset 0 == byte 0):
+#   10 model, 11 version minor, 12 version major, 13 ID, 14 battery %, 15-16 elapsed,
+#   17-18 temperature (SHT3x raw), 24 humidity, 25-27 weight L, 28-30 weight R (24 bit big endian)
+# The single bytes and 16 bit values are signed, as scanner.py has always read them ("b" and "h").
+BGAPI_FRAME = struct.Struct("<10xbbbbbhh5xb3s3s")
+
+Advertisement = namedtuple("Advertisement", ["Model", "VersionMajor", "VersionMinor", "SampleNumber", "BatteryPercent",
+                                             "TemperatureC", "HumidityPercent", "Weight"])
+
+BgapiAdvertisement = namedtuple("BgapiAdvertisement", ["Model", "VersionMajor", "VersionMinor", "Id", "BatteryPercent",
+                                                       "SampleNumber", "TemperatureF", "HumidityPercent", "WeightL", "WeightR"])
+
+
+def is_broodminder(data) -> bool:
+    return data is not None and bytes(data[:2]) == BM_MANUFACTURER_PREFIX
+
+
+def _v1_temperature(raw):
+    return raw / 65536 * 165 - 40
+
+
+def _v2_temperature(raw):
+    return (raw - 5000) / 100
+
+
+def _v2_weight(left, right):
+    weight = (left - 32767) / 100 + (right - 32767) / 100
+    # If the weight is a positive number, it's good. If it's negative, we know it's a false reading.
+    # Note wildly negative readings happen on T&H devices, so we always need to trap for this.
+    if weight > -1:
+        return weight
+    return None
+
+
+def decode_v1(data) -> Advertisement:
+    (_, model, minor, major, battery, elapsed, temperature, humidity) = ADV_V1.unpack_from(data)
+    return Advertisement(model, major, minor, elapsed, battery, _v1_temperature(temperature), humidity, None)
+
+
+def decode_v2(data) -> Advertisement:
+    (_, model, minor, major, battery, elapsed, temperature, weightL, weightR, humidity) = ADV_V2.unpack_from(data)
+    return Advertisement(model, major, minor, elapsed, battery, _v2_temperature(temperature), humidity,
+                         _v2_weight(weightL, weightR))
+
+
+def decode(data) -> Advertisement:
+    # Decode BroodMinder manufacturer data, picking the layout from the firmware major version.
+    # Returns None if the data isn't a (complete) BroodMinder advertisement.
+    if not is_broodminder(data) or len(data) < ADV_LENGTH:
+        return None
+    if data[4] == 1:
+        return decode_v1(data)
+    return decode_v2(data)
+
+
+def decode_bgapi(data) -> BgapiAdvertisement:
+    # Decode a scale advertisement as received by the BlueGiga client. Returns None if the frame is too short.
+    if len(data) < BGAPI_FRAME.size:
+        return None
+    (model, minor, major, idNum, battery, elapsed, temperature, humidity, weightL, weightR) = BGAPI_FRAME.unpack_from(data)
+    # From Datasheet SHT3x-DIS
+    temperatureF = temperature * 315 / (2**16 - 1) - 49
+    return BgapiAdvertisement(model, major, minor, idNum, battery, elapsed, temperatureF, humidity,
+                              _bgapi_weight(weightL), _bgapi_weight(weightR))
+
+
+def _bgapi_weight(raw):
+    # scanner.py has always sign extended the weights only when the top byte is 0xFF.
+    return int.from_bytes(raw, "big", signed=raw[0] == 0xFF)
+
+
+def _batch_dtype(np, stride):
+    return np.dtype({
+        "names": ["prefix", "model", "minor", "major", "battery", "elapsed", "temperature", "weightL", "weightR", "humidity"],
+        "formats": ["<u2", "u1", "u1", "u1", "u1", "<u2", "<u2", "<u2", "<u2", "u1"],
+        "offsets": [0, 2, 3, 4, 6, 7, 9, 12, 14, 16],
+        "itemsize": stride,
+    })
+
+
+def decode_batch(frames, stride=None):
+    # Decode many advertisements at once with NumPy. `frames` can be:
+    #   - a 2D uint8 array, one advertisement per row (rows at least ADV_LENGTH long)
+    #   - a bytes-like buffer of fixed-size records (pass the record size as `stride`)
+    #   - a sequence of bytes objects (or None), which are truncated/padded to ADV_LENGTH
+    # Returns a dict of column arrays. Rows that aren't complete BroodMinder advertisements have valid == False,
+    # the same ones decode() returns None for, and weight is NaN where there is no valid weight.
+    import numpy as np
+
+    complete = None
+    if isinstance(frames, np.ndarray):
+        if frames.ndim != 2 or frames.shape[1] < ADV_LENGTH:
+            raise ValueError("frames must be a 2D array with at least {} columns".format(ADV_LENGTH))
+        buffer = np.ascontiguousarray(frames, dtype=np.uint8)
+        stride = buffer.shape[1]
+    elif isinstance(frames, (bytes, bytearray, memoryview)):
+        if stride is None or stride < ADV_LENGTH:
+            raise ValueError("stride must be given and at least {} for a flat buffer".format(ADV_LENGTH))
+        buffer = frames
+    else:
+        frames = [bytes(f[:ADV_LENGTH]) if f is not None else b"" for f in frames]
+        stride = ADV_LENGTH
+        buffer = b"".join(f.ljust(ADV_LENGTH, b"\x00") for f in frames)
+        complete = np.fromiter((len(f) == ADV_LENGTH for f in frames), dtype=bool, count=len(frames))
+
+    records = np.frombuffer(buffer, dtype=_batch_dtype(np, stride))
+    major = records["major"]
+    v1 = major == 1
+
+    temperature = records["temperature"].astype(np.float64)
+    temperatureC = np.where(v1, _v1_temperature(temperature), _v2_temperature(temperature))
+
+    weight = (records["weightL"].astype(np.float64) - 32767) / 100 + (records["weightR"].astype(np.float64) - 32767) / 100
+    weight[(weight <= -1) | v1] = np.nan
+
+    valid = records["prefix"] == 0x028D
+    if complete is not None:
+        valid &= complete
+
+    return {
+        "valid": valid,
+        "model": records["model"].copy(),
+        "version_major": major.copy(),
+        "version_minor": records["minor"].copy(),
+        "sample": records["elapsed"].copy(),
+        "battery": records["battery"].copy(),
+        "temperature_c": temperatureC,
+        "humidity": records["humidity"].copy(),
+        "weight": weight,
+    }
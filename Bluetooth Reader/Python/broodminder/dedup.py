@@ -0,0 +1,117 @@
+#
+# Remembers which (DeviceId, SampleNumber) pairs have already been sent, so that the same advertisement heard
+# again (every few seconds until the device takes its next sample) isn't uploaded again.
+#
+# Entries expire after `ttl` seconds and the oldest are evicted once there are more than `max_size`.
+# The sample number is the device's 16-bit elapsed counter, so it wraps back to 0; pairs are compared on the
+# masked 16-bit value and the TTL is far shorter than the time the counter takes to come round again, so a
+# wrapped counter is always seen as a new sample.
+#
+# A sample is remembered as soon as it is checked, so the copies heard while it waits to be sent aren't queued
+# as well; if it then doesn't get sent after all, forget() it so the next copy is.
+#
+# Optionally the index is saved to a JSON file every save_interval seconds, from a background thread so the
+# scan delegate never waits on the disk, so that a restart doesn't re-send everything in range.
+#
+
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from broodminder.jsonfile import save_json
+
+
+class SampleDedup:
+    def __init__(self, ttl=6 * 3600, max_size=10000, path=None, save_interval=60):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()  # (deviceId, sample) -> time first seen, oldest first.
+        self.checked = 0
+        self.skipped = 0
+        self.changed = False
+        self.stopping = threading.Event()
+        self.saver = None
+        if path is not None:
+            self._load()
+            self.saver = threading.Thread(target=self._save_periodically, name="dedup-saver", daemon=True)
+            self.saver.start()
+
+    def is_duplicate(self, deviceId, sampleNumber) -> bool:
+        # Returns True if this sample has been seen recently, otherwise records it and returns False.
+        key = (deviceId, sampleNumber & 0xFFFF)
+        now = time.time()
+        with self.lock:
+            self.checked += 1
+            self._expire(now)
+            if key in self.seen:
+                self.skipped += 1
+                return True
+            self.seen[key] = now
+            while len(self.seen) > self.max_size:
+                self.seen.popitem(last=False)
+            self.changed = True
+        return False
+
+    def forget(self, deviceId, sampleNumber):
+        # The sample wasn't sent after all (dropped or failed), so don't skip it next time it's heard.
+        with self.lock:
+            if self.seen.pop((deviceId, sampleNumber & 0xFFFF), None) is not None:
+                self.changed = True
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "checked": self.checked,
+                "skipped": self.skipped,
+                "skip_rate": self.skipped / self.checked if self.checked else 0.0,
+                "size": len(self.seen),
+            }
+
+    def close(self):
+        if self.saver is not None:
+            self.stopping.set()
+            self.saver.join()
+            self._save()
+
+    def _expire(self, now):
+        # Must be called with self.lock held. Entries are in the order they were first seen.
+        while self.seen:
+            key, seenAt = next(iter(self.seen.items()))
+            if now - seenAt < self.ttl:
+                break
+            del self.seen[key]
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print("Ignoring unreadable dedup file {}: {}".format(self.path, e))
+            return
+        now = time.time()
+        for deviceId, sampleNumber, seenAt in sorted(entries, key=lambda e: e[2]):
+            if now - seenAt < self.ttl:
+                self.seen[(deviceId, sampleNumber)] = seenAt
+        while len(self.seen) > self.max_size:
+            self.seen.popitem(last=False)
+
+    def _save_periodically(self):
+        while not self.stopping.wait(self.save_interval):
+            try:
+                self._save()
+            except OSError as e:
+                print("Couldn't save the dedup file {}: {}".format(self.path, e))
+
+    def _save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            entries = [[deviceId, sampleNumber, seenAt] for (deviceId, sampleNumber), seenAt in self.seen.items()]
+            self.changed = False
+        save_json(self.path, entries)
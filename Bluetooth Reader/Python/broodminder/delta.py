@@ -0,0 +1,158 @@
+#
+# Delta uploads: only the rows newer than the server's watermarks, compressed, in resumable chunks.
+#
+# The payload is newline delimited JSON, one array per row in phone_db.READING_COLUMNS order
+# ([deviceId, sample, timestamp, temperatureF, humidity, battery]), compressed with gzip, or zstd if the
+# zstandard package is installed on both ends.
+#
+# Protocol (see sync_client.py for a client):
+#   GET  /watermarks                 -> newest imported timestamp per device, and the encodings the server accepts
+#   POST /uploads                    -> start a session ({"encoding": "gzip"}), returns its id
+#   GET  /uploads/<id>               -> how many bytes the server has, i.e. where to resume from
+#   PUT  /uploads/<id>?offset=N      -> append the request body at offset N; a wrong offset gets 409 and the real one
+#   POST /uploads/<id>/complete      -> check the optional sha256 and queue the import, like /upload
+#
+# Sessions are just files in the upload folder, so an interrupted upload can carry on after a server restart.
+# Sessions that haven't been touched for `max_age` seconds are deleted.
+#
+
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip",)
+
+SESSION_PREFIX = "broodminder_delta_"
+SESSION_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UnknownUpload(Exception):
+    pass
+
+
+class OffsetMismatch(Exception):
+    def __init__(self, offset):
+        super().__init__("Upload is at offset {}".format(offset))
+        self.offset = offset
+
+
+def open_rows(path, encoding):
+    # Decompressing binary reader for a payload file.
+    if encoding == "gzip":
+        return gzip.open(path, "rb")
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+    raise ValueError("Unsupported encoding {}".format(encoding))
+
+
+def read_rows(path, encoding, chunk_size=5000):
+    # Yields lists of row tuples, like phone_db.stream_readings(). Raises ValueError on a malformed row.
+    with open_rows(path, encoding) as raw:
+        chunk = []
+        for line in io.TextIOWrapper(raw, encoding="utf-8"):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if not isinstance(row, list) or len(row) != 6:
+                raise ValueError("Expected a row of 6 values, got {!r}".format(line[:100]))
+            chunk.append(tuple(row))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def write_rows(path, rows, encoding) -> int:
+    # Compress rows (sequences in READING_COLUMNS order) to a payload file. Returns the number of rows.
+    if encoding == "gzip":
+        out = gzip.open(path, "wb")
+    elif encoding == "zstd" and zstandard is not None:
+        out = zstandard.ZstdCompressor().stream_writer(open(path, "wb"), closefd=True)
+    else:
+        raise ValueError("Unsupported encoding {}".format(encoding))
+    count = 0
+    with out:
+        for row in rows:
+            out.write(json.dumps(list(row), separators=(",", ":")).encode("utf-8"))
+            out.write(b"\n")
+            count += 1
+    return count
+
+
+class UploadSessions:
+    def __init__(self, folder, max_age=24 * 3600):
+        self.folder = folder
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+    def create(self, encoding) -> str:
+        if encoding not in ENCODINGS:
+            raise ValueError("encoding must be one of {}".format(", ".join(ENCODINGS)))
+        self.cleanup()
+        uploadId = uuid.uuid4().hex
+        open(self._path(uploadId, encoding), "wb").close()
+        return uploadId
+
+    def offset(self, uploadId) -> int:
+        return os.path.getsize(self._find(uploadId)[0])
+
+    def append(self, uploadId, offset, stream) -> int:
+        # Append everything from the file-like `stream` if the upload is at `offset`. Returns the new offset.
+        with self.lock:
+            path, _ = self._find(uploadId)
+            current = os.path.getsize(path)
+            if offset != current:
+                raise OffsetMismatch(current)
+            with open(path, "ab") as f:
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+            return os.path.getsize(path)
+
+    def finish(self, uploadId, sha256=None):
+        # Ends the session and returns (path, encoding) of the payload; the caller owns the file from then on.
+        with self.lock:
+            path, encoding = self._find(uploadId)
+            if sha256 is not None:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(block)
+                if digest.hexdigest() != sha256.lower():
+                    raise ValueError("sha256 doesn't match, the upload is corrupt; start again")
+            finished = path[:-len(".part")]
+            os.replace(path, finished)
+            return finished, encoding
+
+    def cleanup(self):
+        cutoff = time.time() - self.max_age
+        for path in glob.glob(os.path.join(self.folder, SESSION_PREFIX + "*.part")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _path(self, uploadId, encoding):
+        return os.path.join(self.folder, "{}{}.ndjson.{}.part".format(SESSION_PREFIX, uploadId, encoding))
+
+    def _find(self, uploadId):
+        if not SESSION_ID.match(uploadId or ""):
+            raise UnknownUpload(uploadId)
+        for encoding in ENCODINGS:
+            path = self._path(uploadId, encoding)
+            if os.path.exists(path):
+                return path, encoding
+        raise UnknownUpload(uploadId)
@@ -0,0 +1,213 @@
+#
+# Bulk writes to InfluxDB.
+#
+# Rather than building an influxdb_client.Point and doing one blocking HTTP request per reading, readings
+# are turned straight into line protocol and written in large batches. BatchWriter keeps a bounded number of
+# batches in flight on a thread pool and retries failed batches with jittered exponential backoff.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from broodminder.metrics import REGISTRY, RETRIES, WRITE_SECONDS
+from broodminder.retry import retry
+
+MEASUREMENT = "broodminder"
+
+
+def _escape_key(value):
+    # Measurement names, tag keys/values and field keys.
+    return str(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _escape_string(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def format_field(value):
+    # Same rules as influxdb_client.Point, so batched writes don't change field types:
+    # ints get the "i" suffix, whole floats lose their trailing ".0", strings are quoted.
+    # Returns None for values that should be skipped.
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return "{}i".format(value)
+    if isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")):
+            return None
+        s = str(value)
+        if s.endswith(".0"):
+            s = s[:-2]
+        return s
+    return '"{}"'.format(_escape_string(str(value)))
+
+
+def line_protocol(measurement, tags, fields, timestamp=None):
+    # Build one line of line protocol. tags and fields are dicts; tags are sorted like Point does,
+    # fields keep their order. Returns None if there are no fields to write.
+    field_parts = []
+    for key, value in fields.items():
+        formatted = format_field(value)
+        if formatted is not None:
+            field_parts.append("{}={}".format(_escape_key(key), formatted))
+    if not field_parts:
+        return None
+
+    line = _escape_key(measurement)
+    for key in sorted(tags):
+        value = tags[key]
+        if value is not None and value != "":
+            line += ",{}={}".format(_escape_key(key), _escape_key(value))
+    line += " " + ",".join(field_parts)
+    if timestamp is not None:
+        line += " {}".format(int(timestamp))
+    return line
+
+
+def reading_line(deviceId, temperatureC, humidity, battery, sampleNumber, timestamp=None, weight=None):
+    # Line protocol for a single reading in the "broodminder" measurement (timestamp in seconds).
+    return line_protocol(MEASUREMENT, {"deviceId": deviceId}, {
+        "temperature": temperatureC,
+        "humidity": humidity,
+        "battery": battery,
+        "sampleNumber": sampleNumber,
+        "weight": weight,
+    }, timestamp)
+
+
+BATCH_ROWS = REGISTRY.counter("broodminder_influxdb_batch_rows_total", "Rows written by the batch writer, by outcome", ["outcome"])
+
+
+class BatchWriter:
+    def __init__(self, write, batch_size=5000, flush_interval=1.0, max_in_flight=4, max_retries=5, retry_interval=0.5):
+        # write is called with a single line protocol string holding a whole batch, and should raise on failure.
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+
+        self.lock = threading.Lock()
+        self.batch = []
+        self.batch_started = None
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="influx-writer")
+
+        self.started = time.monotonic()
+        self.rows = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed_batches = 0
+        self.failed_rows = 0
+        self.errors = []
+
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self._flush_periodically, name="influx-flusher", daemon=True)
+        self.timer.start()
+
+    def add(self, line):
+        if line is None:
+            return
+        with self.lock:
+            if not self.batch:
+                self.batch_started = time.monotonic()
+            self.batch.append(line)
+            if len(self.batch) < self.batch_size:
+                return
+            batch = self._take_batch()
+        self._submit(batch)
+
+    def add_many(self, lines):
+        for line in lines:
+            self.add(line)
+
+    def flush(self):
+        with self.lock:
+            batch = self._take_batch()
+        if batch:
+            self._submit(batch)
+
+    def drain(self):
+        # Flush and wait for every batch added so far to be written (or to have failed).
+        self.flush()
+        for _ in range(self.max_in_flight):
+            self.in_flight.acquire()
+        for _ in range(self.max_in_flight):
+            self.in_flight.release()
+
+    def close(self) -> dict:
+        # Flush what's left, wait for every batch to finish and return the stats.
+        self.closed.set()
+        self.timer.join()
+        self.flush()
+        self.executor.shutdown(wait=True)
+        return self.stats()
+
+    def stats(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "rows": self.rows,
+            "batches": self.batches,
+            "retries": self.retries,
+            "failed_batches": self.failed_batches,
+            "failed_rows": self.failed_rows,
+            "seconds": round(elapsed, 3),
+            "rows_per_sec": round(self.rows / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+    def _take_batch(self):
+        # Must be called with self.lock held.
+        batch = self.batch
+        self.batch = []
+        self.batch_started = None
+        return batch
+
+    def _flush_periodically(self):
+        while not self.closed.wait(self.flush_interval / 2):
+            with self.lock:
+                if self.batch_started is None or time.monotonic() - self.batch_started < self.flush_interval:
+                    continue
+                batch = self._take_batch()
+            self._submit(batch)
+
+    def _submit(self, batch):
+        # Blocks once max_in_flight batches are outstanding, which keeps memory bounded on big imports.
+        self.in_flight.acquire()
+        try:
+            self.executor.submit(self._write_batch, batch)
+        except Exception:
+            self.in_flight.release()
+            raise
+
+    def _write_batch(self, batch):
+        try:
+            body = "\n".join(batch)
+            try:
+                retry(lambda: self._write_once(body), self.max_retries, self.retry_interval, on_retry=self._retried)
+            except Exception as e:
+                print("InfluxDB batch of {} rows failed after {} retries: {}".format(len(batch), self.max_retries, e))
+                BATCH_ROWS.inc(len(batch), outcome="failed")
+                with self.lock:
+                    self.failed_batches += 1
+                    self.failed_rows += len(batch)
+                    self.errors.append(str(e))
+                return
+            BATCH_ROWS.inc(len(batch), outcome="written")
+            with self.lock:
+                self.rows += len(batch)
+                self.batches += 1
+        finally:
+            self.in_flight.release()
+
+    def _write_once(self, body):
+        with WRITE_SECONDS.time(sink="influxdb_batch"):
+            self.write(body)
+
+    def _retried(self, e):
+        with self.lock:
+            self.retries += 1
+        RETRIES.inc(component="influxdb_batch")
@@ -0,0 +1,122 @@
+#
+# Bounded background job queue for the import server.
+#
+# Uploads are put on a queue and processed by a fixed pool of worker threads, so a request returns straight
+# away with a job id and several phones can sync at once. The import work is almost all waiting on sqlite
+# and HTTP, so threads are enough to run imports in parallel.
+#
+
+from collections import OrderedDict
+import queue
+import threading
+import time
+import uuid
+
+from broodminder.metrics import PROFILER, REGISTRY
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+JOBS = REGISTRY.counter("broodminder_jobs_total", "Finished jobs, by status", ["status"])
+JOB_SECONDS = REGISTRY.histogram("broodminder_job_seconds", "Time taken to run each job", buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600))
+QUEUE_DEPTH = REGISTRY.gauge("broodminder_job_queue_depth", "Jobs waiting for a worker")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, args):
+        self.id = uuid.uuid4().hex
+        self.args = args
+        self.status = QUEUED
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def report(self, **progress):
+        # Called by the handler to publish how far it has got.
+        self.progress = dict(self.progress, **progress)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    def __init__(self, handler, workers=2, max_queued=16, keep_finished=100):
+        # handler(job, *args) does the work and returns the job's result. If it raises, the job is marked failed
+        # with the exception message; exceptions with a `result` attribute keep that as the job's result too.
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.keep_finished = keep_finished
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name="job-worker-{}".format(i), daemon=True)
+            t.start()
+            self.workers.append(t)
+        QUEUE_DEPTH.set_function(self.depth)
+
+    def submit(self, *args) -> Job:
+        job = Job(args)
+        with self.lock:
+            self.jobs[job.id] = job
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job.id]
+            raise QueueFull("{} jobs already queued".format(self.queue.maxsize))
+        return job
+
+    def get(self, jobId) -> Job:
+        with self.lock:
+            return self.jobs.get(jobId)
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.status = RUNNING
+            job.started = time.time()
+            try:
+                with PROFILER.section("job"):
+                    job.result = self.handler(job, *job.args)
+                job.status = DONE
+            except Exception as e:
+                print("Job {} failed: {}".format(job.id, e))
+                job.error = str(e)
+                job.result = getattr(e, "result", None)
+                job.status = FAILED
+            finally:
+                job.finished = time.time()
+                JOBS.inc(status=job.status)
+                JOB_SECONDS.observe(job.finished - job.started)
+                job.args = None  # Don't hang on to clients/files once we're done.
+                self._forget_old_jobs()
+                self.queue.task_done()
+
+    def _forget_old_jobs(self):
+        with self.lock:
+            finished = [j.id for j in self.jobs.values() if j.finished is not None]
+            for jobId in finished[:max(0, len(finished) - self.keep_finished)]:
+                del self.jobs[jobId]
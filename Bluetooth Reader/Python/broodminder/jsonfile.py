@@ -0,0 +1,18 @@
+#
+# Small JSON state files: the import watermarks, the dedup index and the rollup buckets waiting for a flush.
+#
+# Files are rewritten atomically. The new contents go to a temporary file next to the real one, which is then
+# renamed over it, so a crash mid-save leaves the previous version in place.
+#
+
+import json
+import os
+import threading
+
+
+def save_json(path, data):
+    # The temporary name is unique to the process and thread, so concurrent saves can't write into each other.
+    tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,341 @@
+#
+# Minimal metrics registry, rendered in the Prometheus text exposition format.
+#
+# Counters, gauges and histograms with labels, enough for the scanner and the import server to report what
+# they are doing without pulling in another dependency. The import server serves REGISTRY on /metrics; the
+# scanner can serve it on its own small HTTP listener (start_http_server).
+#
+# PROFILER is an opt-in cProfile hook: hot loops run inside PROFILER.section(name), which costs nothing until a
+# profiling window is started; the stats and the time spent in each section are dumped when the window ends.
+#
+
+# http.server, cProfile and pstats are only imported when the HTTP listener or a profiling window is started.
+from contextlib import contextmanager
+import math
+import sys
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape_label(v)) for k, v in pairs) + "}"
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{} expects labels {}, got {}".format(self.name, self.labelnames, tuple(labels)))
+        return tuple(labels[n] for n in self.labelnames)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labelnames, key), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        # For unlabelled gauges that are cheaper to read when scraped, like queue depths.
+        self.function = function
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self.lock:
+            items = sorted((k, (list(c), t)) for k, (c, t) in self.values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labelnames, key, ("le", _format_value(bound))), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labelnames, key), _format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labelnames, key), cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError("{} is already registered as a {}".format(name, metric.type))
+            return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, help, labelnames, buckets)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Shared by every component that sends data, labelled with which one it was.
+WRITE_SECONDS = REGISTRY.histogram("broodminder_sink_write_seconds", "Time taken by each attempt to send data to a sink", ["sink"])
+RETRIES = REGISTRY.counter("broodminder_retries_total", "Failed attempts that were retried", ["component"])
+FAILURES = REGISTRY.counter("broodminder_sink_failures_total", "Readings that couldn't be sent after all the retries", ["sink"])
+
+
+def start_http_server(port, addr="0.0.0.0", registry=REGISTRY):
+    # Serve the registry on http://addr:port/metrics from a background thread.
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+class Profiler:
+    # One cProfile.Profile for the whole process per profiling window. From Python 3.12 a profiler sees every
+    # thread and only one can be active at a time, so it is enabled once by start() and disabled when the window
+    # ends. Before 3.12 a profiler only sees the thread that enables it, so the first thread to enter a section()
+    # in the window owns it and switches it on around its own sections.
+    #
+    # Apart from that, section() only adds up the wall-clock time spent in each named section, and nothing it
+    # does can raise into the code it wraps.
+    PER_THREAD = sys.version_info < (3, 12)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = False
+        self.path = None
+        self.profile = None
+        self.owner = None
+        self.inside = False
+        self.pending = False
+        self.sections = {}
+
+    def start(self, seconds, path) -> bool:
+        # Profile the next `seconds` seconds, then write the stats to `path` (load them with pstats or snakeviz).
+        # Returns False if a window is already running or the profiler couldn't be switched on.
+        with self.lock:
+            if self.active or self.pending:
+                return False
+            import cProfile
+            profile = cProfile.Profile()
+            if not self.PER_THREAD:
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    # Another profiler or debugger is already using the process-wide hook.
+                    print("Couldn't start profiling: {}".format(e))
+                    return False
+            self.active = True
+            self.path = path
+            self.profile = profile
+            self.owner = None
+            self.sections = {}
+        timer = threading.Timer(seconds, self._finish)
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def start_on_signal(self, signum, seconds, path):
+        # Start a window (see start()) whenever the process gets signal `signum`, e.g. SIGUSR1. Signal handlers run
+        # on the main thread, which may be inside a section holding self.lock, so the handler only wakes a thread
+        # that does the starting.
+        import signal
+        requested = threading.Event()
+
+        def starter():
+            while True:
+                requested.wait()
+                requested.clear()
+                self.start(seconds, path)
+
+        threading.Thread(target=starter, name="profile-starter", daemon=True).start()
+        signal.signal(signum, lambda signum, frame: requested.set())
+
+    @contextmanager
+    def section(self, name="section"):
+        if not self.active:
+            yield
+            return
+        owned = self._enter()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._exit(name, time.monotonic() - started, owned)
+
+    def _enter(self) -> bool:
+        # Returns True if this thread switched the per-thread profiler on.
+        if not self.PER_THREAD:
+            return False
+        try:
+            with self.lock:
+                if not self.active or self.owner not in (None, threading.get_ident()) or self.inside:
+                    return False
+                self.owner = threading.get_ident()
+                self.inside = True
+                self.profile.enable()
+                return True
+        except Exception as e:
+            self.inside = False
+            print("Profiling section failed: {}".format(e))
+            return False
+
+    def _exit(self, name, seconds, owned):
+        try:
+            with self.lock:
+                if owned:
+                    self.profile.disable()
+                    self.inside = False
+                if self.active or owned:
+                    calls, total = self.sections.get(name, (0, 0.0))
+                    self.sections[name] = (calls + 1, total + seconds)
+                dump = owned and self.pending
+            if dump:
+                self._dump()
+        except Exception as e:
+            print("Profiling section failed: {}".format(e))
+
+    def _finish(self):
+        with self.lock:
+            self.active = False
+            if self.PER_THREAD and self.inside:
+                # The owning thread is part-way through a section; it writes the stats when it leaves.
+                self.pending = True
+                return
+            if not self.PER_THREAD:
+                self.profile.disable()
+        self._dump()
+
+    def _dump(self):
+        with self.lock:
+            profile, self.profile = self.profile, None
+            sections, self.sections = self.sections, {}
+            path = self.path
+            self.pending = False
+        try:
+            profile.create_stats()
+            if not profile.stats:
+                print("Profiling window ended with nothing profiled")
+                return
+            import pstats
+            pstats.Stats(profile).dump_stats(path)
+            print("Wrote profile to {} ({})".format(path, ", ".join(
+                "{}: {} calls, {:.1f}s".format(name, calls, total) for name, (calls, total) in sorted(sections.items())) or "no sections"))
+        except Exception as e:
+            print("Couldn't write profile to {}: {}".format(path, e))
+
+
+PROFILER = Profiler()
@@ -0,0 +1,191 @@
+#
+# Scan on several Bluetooth adapters at once.
+#
+# Each adapter (hci0, hci1, ...) gets its own worker process running a bluepy Scanner, so a slow or wedged
+# adapter can't hold up the others and decoding is spread over the CPU cores. Workers decode what they hear
+# and put it on a shared queue as plain tuples.
+#
+# The same sample is usually heard by more than one adapter. The merger holds each (device, sample) for
+# `hold` seconds, keeps the copy with the strongest signal, and then hands it on once. Copies that turn up
+# after that are dropped.
+#
+# Workers that die (e.g. the dongle was unplugged) are restarted, backing off up to a minute between tries.
+#
+# Workers are always started with the "spawn" method, so they begin with a clean interpreter rather than a
+# fork of one that already has upload, metrics and spool threads running. Spawned children import the main
+# module again, so the script creating a MultiAdapterScanner must keep its work under an
+# `if __name__ == "__main__":` guard, as BM_Scan.py does; scan_worker itself lives here so it can be imported.
+#
+
+from collections import OrderedDict
+import multiprocessing
+import queue
+import threading
+import time
+
+from broodminder.metrics import REGISTRY
+
+CONTEXT = multiprocessing.get_context("spawn")
+
+ADAPTER_READINGS = REGISTRY.counter("broodminder_adapter_readings_total", "Readings decoded by each adapter", ["adapter"])
+ADAPTER_RESTARTS = REGISTRY.counter("broodminder_adapter_restarts_total", "Times each adapter's scanning process was restarted", ["adapter"])
+MERGED = REGISTRY.counter("broodminder_adapter_merged_total", "Readings heard by more than one adapter that were merged")
+
+COMPLETE_LOCAL_NAME = 9
+
+
+def scan_worker(hci, window, readings, stop):
+    # Runs in a child process. Puts (hci, rssi, deviceId, sample, temperatureC, humidity, battery, weight,
+    # timestamp) tuples on `readings` until `stop` is set.
+    from bluepy.btle import BTLEDisconnectError, DefaultDelegate, Scanner
+    from broodminder.decode import decode, is_broodminder
+
+    class QueueDelegate(DefaultDelegate):
+        def handleDiscovery(self, dev, isNewDev, isNewData):
+            if not (isNewDev or isNewData):
+                return
+            manufacturerData = dev.getValue(255)
+            if not is_broodminder(manufacturerData):
+                return
+            deviceId = dev.getValueText(COMPLETE_LOCAL_NAME)
+            if deviceId is None:
+                # The name arrives in the scan response, we'll get another go when that turns up.
+                return
+            adv = decode(manufacturerData)
+            if adv is not None:
+                readings.put((hci, dev.rssi, deviceId, adv.SampleNumber, adv.TemperatureC, adv.HumidityPercent,
+                              adv.BatteryPercent, adv.Weight, time.time()))
+
+    scanner = Scanner(hci).withDelegate(QueueDelegate())
+    while not stop.is_set():
+        try:
+            scanner.scan(window)
+        except BTLEDisconnectError:
+            pass
+
+
+class MultiAdapterScanner:
+    def __init__(self, adapters, on_reading, window=10.0, hold=2.0, remember=600):
+        # on_reading(deviceId, sample, temperatureC, humidity, battery, weight, timestamp, rssi) is called from
+        # the merge thread once per (device, sample).
+        self.adapters = list(adapters)
+        self.on_reading = on_reading
+        self.window = window
+        self.hold = hold
+        self.remember = remember
+        self.readings = CONTEXT.Queue()
+        self.stop_event = CONTEXT.Event()
+        self.processes = {}
+        self.restarts = {hci: 0 for hci in self.adapters}
+        self.pending = OrderedDict()  # (deviceId, sample) -> [deadline, rssi, reading]
+        self.emitted = OrderedDict()  # (deviceId, sample) -> time it was handed on
+        self.stats_lock = threading.Lock()
+        self.received = 0
+        self.merged = 0
+        self.threads = []
+
+    def start(self):
+        for hci in self.adapters:
+            self._start_worker(hci)
+        for target, name in ((self._merge, "adapter-merge"), (self._supervise, "adapter-supervisor")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self, timeout=15.0):
+        # Stop the workers and hand on anything still being held. Workers finish their current scan window first.
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process in list(self.processes.values()):
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        for t in self.threads:
+            t.join()
+        self._release(float("inf"))
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                "received": self.received,
+                "merged": self.merged,
+                "alive": sorted(hci for hci, p in self.processes.items() if p.is_alive()),
+                "restarts": dict(self.restarts),
+            }
+
+    def _start_worker(self, hci):
+        process = CONTEXT.Process(target=scan_worker, args=(hci, self.window, self.readings, self.stop_event),
+                                          name="scan-hci{}".format(hci), daemon=True)
+        process.start()
+        self.processes[hci] = process
+
+    def _supervise(self):
+        backoff = {hci: 1.0 for hci in self.adapters}
+        nextStart = {}
+        while not self.stop_event.wait(1.0):
+            now = time.monotonic()
+            for hci, process in list(self.processes.items()):
+                if process.is_alive():
+                    continue
+                if hci not in nextStart:
+                    print("Scanning on hci{} stopped (exit code {}), restarting in {:.0f}s".format(hci, process.exitcode, backoff[hci]))
+                    nextStart[hci] = now + backoff[hci]
+                    backoff[hci] = min(backoff[hci] * 2, 60.0)
+                elif now >= nextStart.pop(hci):
+                    with self.stats_lock:
+                        self.restarts[hci] += 1
+                    ADAPTER_RESTARTS.inc(adapter="hci{}".format(hci))
+                    self._start_worker(hci)
+
+    def _merge(self):
+        # Keeps reading until the workers have all exited, as a worker can't exit until what it has put on the
+        # queue has been read.
+        while True:
+            try:
+                reading = self.readings.get(timeout=min(self.hold, 0.5))
+            except queue.Empty:
+                reading = None
+                if self.stop_event.is_set() and not any(p.is_alive() for p in list(self.processes.values())):
+                    return
+            if reading is not None:
+                self._add(reading)
+            self._release(time.monotonic())
+
+    def _add(self, reading):
+        hci, rssi, deviceId, sample = reading[:4]
+        ADAPTER_READINGS.inc(adapter="hci{}".format(hci))
+        key = (deviceId, sample)
+        with self.stats_lock:
+            self.received += 1
+            if key in self.emitted:
+                self.merged += 1
+                MERGED.inc()
+                return
+            held = self.pending.get(key)
+            if held is None:
+                self.pending[key] = [time.monotonic() + self.hold, rssi, reading]
+                return
+            self.merged += 1
+            MERGED.inc()
+            if rssi > held[1]:
+                held[1] = rssi
+                held[2] = reading
+
+    def _release(self, now):
+        ready = []
+        with self.stats_lock:
+            while self.pending:
+                key, (deadline, rssi, reading) = next(iter(self.pending.items()))
+                if deadline > now:
+                    break
+                del self.pending[key]
+                self.emitted[key] = time.monotonic()
+                ready.append(reading)
+            while self.emitted and next(iter(self.emitted.values())) < time.monotonic() - self.remember:
+                self.emitted.popitem(last=False)
+        for (hci, rssi, deviceId, sample, temperatureC, humidity, battery, weight, timestamp) in ready:
+            try:
+                self.on_reading(deviceId, sample, temperatureC, humidity, battery, weight, timestamp, rssi)
+            except Exception as e:
+                print("Couldn't handle reading from device '{}': {}".format(deviceId, e))
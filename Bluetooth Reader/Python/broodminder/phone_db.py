@@ -0,0 +1,39 @@
+#
+# Streaming reader for the sqlite database uploaded by the BroodMinder phone app.
+#
+# The database is opened read-only with memory-mapped I/O and StoredSensorReading is read in one pass, in
+# storage (rowid) order, so sqlite never has to sort or build a temporary index. Rows come back as plain
+# tuples in chunks of `chunk_size`, which keeps memory flat however big the upload is.
+#
+
+import sqlite3
+import urllib.parse
+
+READING_COLUMNS = ("DeviceId", "Sample", "Timestamp", "Temperature", "Humidity", "Battery")
+
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+
+def open_readonly(path, mmap_size=DEFAULT_MMAP_SIZE, immutable=True) -> sqlite3.Connection:
+    # immutable=1 tells sqlite nothing else will touch the file, so it skips locking and won't create -wal/-shm files.
+    # Only use it on a private copy such as a spooled upload: it ignores the -wal file, so on a database another
+    # process is writing (the phone app's own) pass immutable=False to read it with normal locking.
+    uri = "file:{}?mode=ro".format(urllib.parse.quote(path))
+    if immutable:
+        uri += "&immutable=1"
+    db = sqlite3.connect(uri, uri=True)
+    db.execute("PRAGMA mmap_size = {}".format(int(mmap_size)))
+    return db
+
+
+def stream_readings(db: sqlite3.Connection, chunk_size=5000):
+    # Yields lists of (DeviceId, Sample, Timestamp, Temperature (F), Humidity, Battery) tuples.
+    cur = db.execute("SELECT {} FROM StoredSensorReading ORDER BY rowid".format(", ".join(READING_COLUMNS)))
+    try:
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cur.close()
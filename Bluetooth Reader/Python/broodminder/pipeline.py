@@ -0,0 +1,88 @@
+#
+# Hands decoded readings from the scanner over to a sink on a separate thread.
+#
+# The scanner pushes readings into a bounded queue and keeps listening; a consumer thread takes them off
+# and forwards them to the sink (cloud upload, InfluxDB, ...). If the sink falls so far behind that the
+# queue fills up, the oldest readings are dropped in favour of new ones.
+#
+# If a SampleDedup is given, readings whose sample has already been sent are skipped before they are queued,
+# so they never cost any network I/O. Readings that are dropped, or that the sink fails to send, are forgotten
+# by the dedup again so the next copy heard gets another chance.
+#
+
+import queue
+import threading
+
+from broodminder.metrics import PROFILER, REGISTRY
+
+_STOP = object()
+
+READINGS = REGISTRY.counter("broodminder_pipeline_readings_total", "Readings handed to the pipeline, by what happened to them",
+                            ["outcome"])
+QUEUE_DEPTH = REGISTRY.gauge("broodminder_pipeline_queue_depth", "Readings waiting to be sent")
+
+
+class SinkPipeline:
+    def __init__(self, sink, max_queued=1000, dedup=None):
+        # sink is called with one BroodMinderResult at a time, on the consumer thread.
+        self.sink = sink
+        self.dedup = dedup
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.submitted = 0
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._consume, name="sink-pipeline", daemon=True)
+        QUEUE_DEPTH.set_function(self.depth)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, result):
+        if self.dedup is not None and self.dedup.is_duplicate(result.DeviceId, result.SampleNumber):
+            READINGS.inc(outcome="duplicate")
+            return
+        self.submitted += 1
+        READINGS.inc(outcome="queued")
+        while True:
+            try:
+                self.queue.put_nowait(result)
+                return
+            except queue.Full:
+                try:
+                    dropped = self.queue.get_nowait()
+                    self.queue.task_done()
+                    self.dropped += 1
+                    READINGS.inc(outcome="dropped")
+                    self._forget(dropped)
+                except queue.Empty:
+                    pass
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def close(self, timeout=None):
+        # Let the consumer finish everything already queued, then stop it.
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+
+    def _consume(self):
+        while True:
+            result = self.queue.get()
+            try:
+                if result is _STOP:
+                    return
+                with PROFILER.section("sink"):
+                    self.sink(result)
+            except Exception as e:
+                # Never let one bad upload kill the consumer.
+                self.failed += 1
+                READINGS.inc(outcome="failed")
+                print("Failed to send data for device '{}': {}".format(getattr(result, "DeviceId", None), e))
+                self._forget(result)
+            finally:
+                self.queue.task_done()
+
+    def _forget(self, result):
+        if self.dedup is not None and result is not _STOP:
+            self.dedup.forget(result.DeviceId, result.SampleNumber)
@@ -0,0 +1,76 @@
+#
+# In-process cache of InfluxDB query results for the read API.
+#
+# Entries are kept in least-recently-used order up to `max_entries`, and each one expires after `ttl` seconds
+# so that data written by something other than the importer (e.g. BM_Scan.py writing straight to InfluxDB)
+# still shows up. Every entry belongs to a device, or to ALL_DEVICES for results that cover every device; the
+# importer calls invalidate() with the devices it wrote rows for, which drops just their entries (and the
+# ALL_DEVICES ones).
+#
+# A result that was being loaded while its device was invalidated isn't cached, so a slow query can't put
+# stale data back after an import.
+#
+
+from collections import OrderedDict
+import threading
+import time
+
+from broodminder.metrics import REGISTRY
+
+ALL_DEVICES = None
+
+LOOKUPS = REGISTRY.counter("broodminder_query_cache_lookups_total", "Read API cache lookups", ["result"])
+
+
+class QueryCache:
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires, deviceId, value)
+        self.generations = {}  # deviceId -> number of times it has been invalidated
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, deviceId, load):
+        # Return the cached value for key, calling load() to fetch it if it isn't cached or has expired.
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                LOOKUPS.inc(result="hit")
+                return entry[2]
+            self.misses += 1
+            generation = self._generation(deviceId)
+        LOOKUPS.inc(result="miss")
+
+        value = load()
+        with self.lock:
+            if self._generation(deviceId) == generation:
+                self.entries[key] = (time.monotonic() + self.ttl, deviceId, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, deviceIds):
+        # Forget everything cached for these devices, and anything covering all devices.
+        deviceIds = set(deviceIds)
+        if not deviceIds:
+            return
+        deviceIds.add(ALL_DEVICES)
+        with self.lock:
+            for deviceId in deviceIds:
+                self.generations[deviceId] = self.generations.get(deviceId, 0) + 1
+            for key in [k for k, entry in self.entries.items() if entry[1] in deviceIds]:
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def _generation(self, deviceId):
+        # Must be called with self.lock held.
+        return self.generations.get(deviceId, 0)
@@ -0,0 +1,31 @@
+#
+# A single reading from a BroodMinder device, as passed between the scanner, the spool and the sinks.
+#
+# Uses __slots__ so each buffered reading is a handful of pointers rather than a dict; the scanner can have
+# thousands of them queued or spooled while a sink is down.
+#
+
+import time
+
+
+class BroodMinderResult:
+    __slots__ = ("DeviceId", "SampleNumber", "TemperatureC", "HumidityPercent", "BatteryPercent", "Weight", "Timestamp")
+
+    def __init__(self, deviceId, sampleNumber, temperatureC, humidityPercent, batteryPercent, weight = None, timestamp = None):
+        self.DeviceId = deviceId
+        self.SampleNumber = sampleNumber
+        self.TemperatureC = temperatureC
+        self.HumidityPercent = humidityPercent
+        self.BatteryPercent = batteryPercent
+        self.Weight = weight # TH devices don't have weight, so by default this will be None.
+        # When the reading was received, so it keeps its time if it has to be spooled and sent later.
+        self.Timestamp = timestamp if timestamp is not None else time.time()
+
+    # The MyBroodMinder API expects the temperature in F :(
+    @property
+    def TemperatureF(self):
+        return round((self.TemperatureC * 9 / 5) + 32, 1)
+
+    def __repr__(self):
+        return "BroodMinderResult({!r}, sample={}, {}C, {}%, battery={}%, weight={}, at {})".format(
+            self.DeviceId, self.SampleNumber, self.TemperatureC, self.HumidityPercent, self.BatteryPercent, self.Weight, self.Timestamp)
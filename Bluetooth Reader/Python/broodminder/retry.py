@@ -0,0 +1,23 @@
+#
+# Retrying with jittered exponential backoff, shared by the cloud uploader and the InfluxDB batch writer.
+#
+
+import random
+import time
+
+
+def retry(attempt, max_retries, interval, retryable=lambda e: True, on_retry=None):
+    # Call attempt() until it returns, retrying up to max_retries times if it raises an exception that
+    # retryable(e) accepts. on_retry(e) is called before each retry. The last exception is re-raised.
+    tries = 0
+    while True:
+        try:
+            return attempt()
+        except Exception as e:
+            if tries >= max_retries or not retryable(e):
+                raise
+            if on_retry is not None:
+                on_retry(e)
+            # Exponential backoff with full jitter.
+            time.sleep(random.uniform(0, interval * (2 ** tries)))
+            tries += 1
@@ -0,0 +1,205 @@
+#
+# Hourly and daily rollups of the readings.
+#
+# Raw readings go to the "broodminder" measurement; alongside them we keep min/max/mean/count per device and
+# field for 1 hour and 1 day buckets, written to "broodminder_1h" and "broodminder_1d", so long-range
+# dashboards read a point per bucket instead of every reading.
+#
+# Rollups are never merged from in-process totals. Writers note which (interval, device, bucket) their raw
+# readings landed in (RollupBatch), and once the raw readings are in InfluxDB RollupEngine.flush() recomputes
+# just those buckets from the raw measurement with one Flux query per interval and overwrites their rollup
+# points. Recomputing is idempotent, so late data, a retried import,
+# two import workers touching the same bucket and the scanner and the import server both writing a device
+# all end up with the same, correct rollup.
+#
+# Imports keep their own batch and flush the buckets they have moved past as they go, so memory is bounded by
+# the buckets in progress rather than the size of the upload. The scanner uses the engine's live batch, which
+# is flushed every flush_interval seconds and saved to a JSON file at the same time so that buckets still
+# waiting for a flush survive a restart.
+#
+
+import json
+import threading
+import time
+
+from broodminder.influx import MEASUREMENT, line_protocol
+from broodminder.jsonfile import save_json
+
+INTERVALS = (("1h", 3600), ("1d", 86400))
+FIELDS = ("temperature", "humidity", "battery")
+AGGREGATES = ("min", "max", "mean", "count")
+
+# Most buckets covered by one Flux query, so a year-long backlog is recomputed in pieces.
+MAX_QUERY_BUCKETS = 24 * 31
+
+
+class RollupBatch:
+    # The buckets that have new raw data and need recomputing.
+    def __init__(self, intervals=INTERVALS):
+        self.intervals = intervals
+        self.lock = threading.Lock()
+        self.keys = set()  # (interval, deviceId, bucket start)
+        self.newest = {}  # deviceId -> newest timestamp added
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, deviceIds, timestamps):
+        # deviceIds and timestamps (epoch seconds) are sequences of the same length.
+        keys = set()
+        newest = {}
+        for deviceId, timestamp in zip(deviceIds, timestamps):
+            deviceId = str(deviceId)
+            timestamp = int(timestamp)
+            if timestamp > newest.get(deviceId, timestamp - 1):
+                newest[deviceId] = timestamp
+            for name, seconds in self.intervals:
+                keys.add((name, deviceId, timestamp - timestamp % seconds))
+        with self.lock:
+            self.keys.update(keys)
+            for deviceId, timestamp in newest.items():
+                self.newest[deviceId] = max(self.newest.get(deviceId, timestamp), timestamp)
+
+    def complete(self) -> int:
+        # How many buckets end at or before their device's newest reading, i.e. won't get more data from an
+        # import that reads each device in time order.
+        with self.lock:
+            return len(self._complete())
+
+    def take(self, complete_only=False) -> set:
+        with self.lock:
+            keys = self._complete() if complete_only else set(self.keys)
+            self.keys -= keys
+        return keys
+
+    def restore(self, keys):
+        # Put back buckets whose flush failed.
+        with self.lock:
+            self.keys.update(keys)
+
+    def _complete(self):
+        # Must be called with self.lock held.
+        seconds = dict(self.intervals)
+        return {k for k in self.keys if k[2] + seconds[k[0]] <= self.newest.get(k[1], 0)}
+
+
+class RollupEngine:
+    def __init__(self, query_api, bucket, intervals=INTERVALS, path=None, flush_interval=300.0):
+        # query_api: influxdb_client QueryApi for the bucket the raw readings are written to.
+        self.query_api = query_api
+        self.bucket = bucket
+        self.intervals = intervals
+        self.path = path
+        self.flush_interval = flush_interval
+        # Flushes are serialised so that an older recompute can't overwrite a newer one.
+        self.lock = threading.Lock()
+        self.live = RollupBatch(intervals)
+        self.last_flush = time.monotonic()
+        if path is not None:
+            self._load()
+
+    def batch(self) -> RollupBatch:
+        return RollupBatch(self.intervals)
+
+    def flush(self, batch: RollupBatch, write, complete_only=False) -> int:
+        # Recompute the batch's buckets from the raw readings and call write(lines). Only call this once the raw
+        # readings are in InfluxDB. If anything fails the buckets are put back in the batch. Returns the number
+        # of rollup points written.
+        keys = batch.take(complete_only)
+        if not keys:
+            return 0
+        try:
+            with self.lock:
+                lines = self._recompute(keys)
+                if lines:
+                    write(lines)
+        except Exception:
+            batch.restore(keys)
+            raise
+        return len(lines)
+
+    def touch(self, deviceIds, timestamps):
+        # Live readings that have been written; they're rolled up at the next flush_live().
+        self.live.add(deviceIds, timestamps)
+
+    def defer(self, batch: RollupBatch):
+        # Move a batch's remaining buckets (e.g. ones whose flush failed) to the live batch, to be retried by
+        # flush_live().
+        self.live.restore(batch.take())
+
+    def flush_live(self, write, force=False) -> int:
+        # Flush the live batch if flush_interval has passed since the last time (or force), and save what's left.
+        if not force and time.monotonic() - self.last_flush < self.flush_interval:
+            return 0
+        self.last_flush = time.monotonic()
+        try:
+            return self.flush(self.live, write)
+        finally:
+            if self.path is not None:
+                self._save()
+
+    def _recompute(self, keys) -> list:
+        lines = []
+        for name, seconds in self.intervals:
+            starts = sorted({k[2] for k in keys if k[0] == name})
+            # Split into time ranges of at most MAX_QUERY_BUCKETS buckets.
+            i = 0
+            while i < len(starts):
+                j = i
+                while j + 1 < len(starts) and starts[j + 1] - starts[i] < MAX_QUERY_BUCKETS * seconds:
+                    j += 1
+                wanted = {k for k in keys if k[0] == name and starts[i] <= k[2] <= starts[j]}
+                lines.extend(self._query(name, seconds, wanted, starts[i], starts[j] + seconds))
+                i = j + 1
+        return lines
+
+    def _query(self, name, seconds, keys, start, stop) -> list:
+        # Every aggregate is converted to float before the union: count gives ints, and min/max keep the field's
+        # type, and tables with the same group key but different column types can't be unioned.
+        devices = sorted({k[1] for k in keys})
+        query = """data = from(bucket: "{0}")
+                    |> range(start: time(v: params.start), stop: time(v: params.stop))
+                    |> filter(fn: (r) => r["_measurement"] == "{1}")
+                    |> filter(fn: (r) => {2})
+                    |> filter(fn: (r) => contains(value: r["deviceId"], set: params.devices))
+                union(tables: [{3}])""".format(
+            self.bucket, MEASUREMENT, " or ".join('r["_field"] == "{}"'.format(f) for f in FIELDS),
+            ", ".join('data |> aggregateWindow(every: {0}s, fn: {1}, timeSrc: "_start", createEmpty: false) '
+                      '|> toFloat() |> set(key: "aggregate", value: "{1}")'.format(seconds, a) for a in AGGREGATES))
+        params = {"start": _rfc3339(start), "stop": _rfc3339(stop), "devices": devices}
+
+        points = {}
+        for r in self.query_api.query_stream(query, params=params):
+            bucketStart = int(r["_time"].timestamp())
+            if (name, r["deviceId"], bucketStart) not in keys or r["_value"] is None:
+                continue
+            value = int(r["_value"]) if r["aggregate"] == "count" else float(r["_value"])
+            points.setdefault((r["deviceId"], bucketStart), {})["{}_{}".format(r["_field"], r["aggregate"])] = value
+        return [line_protocol("{}_{}".format(MEASUREMENT, name), {"deviceId": deviceId}, _ordered(fields), bucketStart)
+                for (deviceId, bucketStart), fields in points.items()]
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                keys = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            print("Ignoring unreadable rollup state {}: {}".format(self.path, e))
+            return
+        self.live.restore((name, deviceId, start) for name, deviceId, start in keys)
+
+    def _save(self):
+        with self.live.lock:
+            keys = [list(key) for key in self.live.keys]
+        save_json(self.path, keys)
+
+
+def _ordered(fields):
+    # Same field order for every point, whatever order Flux returned them in.
+    return {"{}_{}".format(f, a): fields["{}_{}".format(f, a)] for f in FIELDS for a in AGGREGATES
+            if "{}_{}".format(f, a) in fields}
+
+
+def _rfc3339(timestamp) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
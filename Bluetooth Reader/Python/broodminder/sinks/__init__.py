@@ -0,0 +1,55 @@
+#
+# Where BM_Scan.py sends its readings.
+#
+# A sink sends one reading with send(), or a whole backlog with send_batch(), which returns the readings it
+# couldn't send. Sinks raise if a reading can't be sent so that the caller can spool it.
+#
+# A sink that refuses a reading outright (bad request, unknown device, ...) raises RejectedError, or any
+# exception with a true `permanent` attribute. Retrying those is pointless, so they're quarantined rather
+# than spooled.
+#
+# Each sink lives in its own module and is only imported by load_sink(), so the scanner doesn't pay for
+# importing influxdb_client when it's uploading to the cloud, or urllib3 when it's writing to InfluxDB.
+#
+
+import importlib
+
+SINKS = {
+    "cloud": ("broodminder.sinks.cloud", "CloudSink"),
+    "influxdb": ("broodminder.sinks.influxdb", "InfluxDbSink"),
+}
+
+
+class RejectedError(Exception):
+    permanent = True
+
+
+def is_rejected(e) -> bool:
+    return getattr(e, "permanent", False) is True
+
+
+class Sink:
+    def send(self, data):
+        raise NotImplementedError()
+
+    def send_batch(self, readings) -> tuple:
+        # Returns (readings that failed and are worth retrying, readings that were rejected).
+        failed = []
+        rejected = []
+        for data in readings:
+            try:
+                self.send(data)
+            except Exception as e:
+                (rejected if is_rejected(e) else failed).append(data)
+        return failed, rejected
+
+    def close(self):
+        pass
+
+
+def load_sink(name):
+    # Returns the sink class for an --output name.
+    if name not in SINKS:
+        raise ValueError("Unknown output mode {}, not doing anything with results.".format(name))
+    module, cls = SINKS[name]
+    return getattr(importlib.import_module(module), cls)
@@ -0,0 +1,27 @@
+#
+# Uploads readings to the MyBroodMinder cloud.
+#
+
+from broodminder.cloud import UPLOAD_URL, CloudUploader
+from broodminder.sinks import Sink
+
+
+class CloudSink(Sink):
+    # Uploads go through the uploader's thread pool, so send() returns straight away; readings that still fail
+    # after the retries are handed to the uploader's on_failure callback, and rejected ones to on_reject.
+    def __init__(self, uploader: CloudUploader):
+        self.uploader = uploader
+
+    @classmethod
+    def connect(cls, url: str = None, **uploader_options):
+        # uploader_options are passed on to CloudUploader.
+        return cls(CloudUploader(url or UPLOAD_URL, **uploader_options))
+
+    def send(self, data):
+        self.uploader.submit(data)
+
+    def send_batch(self, readings) -> tuple:
+        return self.uploader.upload_many(readings)
+
+    def close(self):
+        self.uploader.close()
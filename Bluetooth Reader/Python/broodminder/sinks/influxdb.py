@@ -0,0 +1,78 @@
+#
+# Writes readings straight to InfluxDB.
+#
+
+from broodminder.influx import reading_line
+from broodminder.metrics import WRITE_SECONDS
+from broodminder.sinks import RejectedError, Sink
+
+# InfluxDB answers these when it won't accept the data at all, e.g. a field changing type.
+REJECTED_STATUSES = (400, 422)
+
+
+class InfluxDbSink(Sink):
+    def __init__(self, write_api, org: str, bucket: str, rollups=None):
+        # rollups: optional broodminder.rollup.RollupEngine. Written readings are rolled up every flush_interval.
+        self.write_api = write_api
+        self.org = org
+        self.bucket = bucket
+        self.rollups = rollups
+        self.client = None
+
+    @classmethod
+    def connect(cls, url: str, token: str, org: str, bucket: str, rollups=False, rollup_path=None):
+        import influxdb_client
+        from influxdb_client.client.write_api import SYNCHRONOUS
+
+        client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+        engine = None
+        if rollups:
+            from broodminder.rollup import RollupEngine
+            engine = RollupEngine(client.query_api(), bucket, path=rollup_path)
+        sink = cls(client.write_api(write_options=SYNCHRONOUS), org, bucket, engine)
+        sink.client = client
+        return sink
+
+    def send(self, data):
+        self._write([data])
+
+    def send_batch(self, readings) -> tuple:
+        # One request for the whole batch. If InfluxDB rejects it, send the readings one at a time so that only
+        # the bad ones are rejected.
+        try:
+            self._write(readings)
+        except RejectedError:
+            if len(readings) == 1:
+                raise
+            return Sink.send_batch(self, readings)
+        return [], []
+
+    def close(self):
+        if self.rollups is not None:
+            self._flush_rollups(force=True)
+        if self.client is not None:
+            self.client.close()
+
+    def _write(self, readings):
+        self._write_lines([reading_line(r.DeviceId, r.TemperatureC, r.HumidityPercent, r.BatteryPercent, r.SampleNumber, r.Timestamp)
+                           for r in readings])
+        if self.rollups is not None:
+            self.rollups.touch([r.DeviceId for r in readings], [r.Timestamp for r in readings])
+            self._flush_rollups()
+
+    def _flush_rollups(self, force=False):
+        # The readings are already written, so a failed rollup mustn't fail them; the buckets are kept for next time.
+        try:
+            self.rollups.flush_live(self._write_lines, force)
+        except Exception as e:
+            print("Couldn't update the rollups, will try again later: {}".format(e))
+
+    def _write_lines(self, lines):
+        try:
+            with WRITE_SECONDS.time(sink="influxdb"):
+                self.write_api.write(org=self.org, bucket=self.bucket, record="\n".join(lines), write_precision="s")
+        except Exception as e:
+            # influxdb_client's ApiException carries the HTTP status.
+            if getattr(e, "status", None) in REJECTED_STATUSES:
+                raise RejectedError("InfluxDB rejected the write: HTTP {}".format(e.status)) from e
+            raise
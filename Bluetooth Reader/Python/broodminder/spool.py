@@ -0,0 +1,238 @@
+#
+# Durable local buffer for readings that couldn't be sent.
+#
+# When InfluxDB or the MyBroodMinder cloud can't be reached, readings are appended to a sqlite database
+# (WAL mode, so appends are cheap and survive a crash or power cut). A SpoolDrainer thread keeps trying the
+# sink and, once it's back, replays the backlog in large batches rather than one request per reading.
+#
+# The spool is capped at max_rows; past that the oldest readings are dropped. Space is given back to the
+# filesystem once the backlog has been drained.
+#
+# Readings the sink rejects outright (e.g. HTTP 400) would never go through however often they were retried,
+# so they are moved to a separate quarantine table instead, where they can be looked at by hand.
+#
+
+from contextlib import contextmanager
+import random
+import sqlite3
+import threading
+import time
+
+from broodminder.metrics import REGISTRY
+from broodminder.sinks import is_rejected
+
+QUARANTINED = REGISTRY.counter("broodminder_spool_quarantined_total", "Readings the sink rejected, moved to the quarantine table")
+
+# The value columns are deliberately untyped so ints come back as ints and floats as floats, which keeps the
+# InfluxDB field types the same whether a reading was sent live or replayed.
+SCHEMA = """CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device_id TEXT NOT NULL,
+    sample,
+    temperature_c,
+    humidity,
+    battery,
+    weight,
+    timestamp
+)"""
+
+QUARANTINE_SCHEMA = """CREATE TABLE IF NOT EXISTS quarantine (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    device_id TEXT NOT NULL,
+    sample,
+    temperature_c,
+    humidity,
+    battery,
+    weight,
+    timestamp,
+    reason TEXT,
+    quarantined_at REAL
+)"""
+
+
+class ReadingSpool:
+    def __init__(self, path, factory, max_rows=1000000):
+        # factory(deviceId, sampleNumber, temperatureC, humidity, battery, weight, timestamp) rebuilds a reading.
+        self.path = path
+        self.factory = factory
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # auto_vacuum has to be set before the table is created for it to take effect.
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.execute(QUARANTINE_SCHEMA)
+        self.rows = self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        self.dropped = 0
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, data):
+        self.append_many([data])
+
+    def append_many(self, readings):
+        if not readings:
+            return
+        with self._transaction():
+            overflow = self._insert(readings)
+        if overflow > 0:
+            print("Spool is full, dropped the oldest {} readings".format(overflow))
+
+    def quarantine(self, readings, reason=None):
+        # Keep readings the sink rejected out of the way of the ones that are still worth retrying.
+        if not readings:
+            return
+        with self._transaction():
+            self._quarantine(readings, reason)
+        QUARANTINED.inc(len(readings))
+        print("Quarantined {} readings the sink rejected: {}".format(len(readings), reason))
+
+    def quarantined(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM quarantine").fetchone()[0]
+
+    def peek(self, limit):
+        # Oldest readings first, as (last id, readings). Pass the id to remove() once they've been sent.
+        with self.lock:
+            rows = self.db.execute("SELECT id, device_id, sample, temperature_c, humidity, battery, weight, timestamp "
+                                   "FROM spool ORDER BY id LIMIT ?", (limit,)).fetchall()
+        if not rows:
+            return None, []
+        return rows[-1][0], [self.factory(*row[1:]) for row in rows]
+
+    def remove(self, upToId):
+        with self.lock:
+            cur = self.db.execute("DELETE FROM spool WHERE id <= ?", (upToId,))
+            self.rows = max(0, self.rows - cur.rowcount)
+
+    def requeue(self, upToId, failed=(), rejected=(), reason=None):
+        # remove(upToId), then put `failed` back on the end of the spool and quarantine `rejected`, all in one
+        # transaction so a crash part-way through can't lose or duplicate readings.
+        with self._transaction():
+            cur = self.db.execute("DELETE FROM spool WHERE id <= ?", (upToId,))
+            self.rows = max(0, self.rows - cur.rowcount)
+            overflow = self._insert(failed) if failed else 0
+            if rejected:
+                self._quarantine(rejected, reason)
+        if overflow > 0:
+            print("Spool is full, dropped the oldest {} readings".format(overflow))
+        if rejected:
+            QUARANTINED.inc(len(rejected))
+            print("Quarantined {} readings the sink rejected: {}".format(len(rejected), reason))
+
+    def compact(self):
+        # Hand the free pages back and fold the WAL into the main database file.
+        with self.lock:
+            self.db.execute("PRAGMA incremental_vacuum")
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @contextmanager
+    def _transaction(self):
+        # Holds the lock for the whole transaction. If anything fails it is rolled back, so the spool is left as
+        # it was and the connection can still be used.
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                self.rows = self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+                raise
+            self.db.execute("COMMIT")
+
+    def _insert(self, readings) -> int:
+        # Call inside _transaction(). Returns how many of the oldest readings were dropped.
+        self.db.executemany("INSERT INTO spool (device_id, sample, temperature_c, humidity, battery, weight, timestamp) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)", _values(readings))
+        self.rows += len(readings)
+        overflow = self.rows - self.max_rows
+        if overflow > 0:
+            self.db.execute("DELETE FROM spool WHERE id IN (SELECT id FROM spool ORDER BY id LIMIT ?)", (overflow,))
+            self.rows -= overflow
+            self.dropped += overflow
+        return max(0, overflow)
+
+    def _quarantine(self, readings, reason):
+        now = time.time()
+        self.db.executemany("INSERT INTO quarantine (device_id, sample, temperature_c, humidity, battery, weight, timestamp, reason, quarantined_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [v + (reason, now) for v in _values(readings)])
+
+
+def _values(readings):
+    return [(r.DeviceId, r.SampleNumber, r.TemperatureC, r.HumidityPercent, r.BatteryPercent, r.Weight, r.Timestamp)
+            for r in readings]
+
+
+class SpoolDrainer:
+    def __init__(self, spool: ReadingSpool, sink, batch_size=1000, interval=5.0, max_backoff=300.0):
+        # sink.send_batch(readings) returns (readings that failed and are worth retrying, readings it rejected).
+        # Raising counts as all of them failing, or all of them being rejected if it's a rejection.
+        self.spool = spool
+        self.sink = sink
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.replayed = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="spool-drainer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        self.thread.join(timeout)
+
+    def drain_once(self, limit=None) -> bool:
+        # Send one batch. Returns False if the sink is still unreachable.
+        lastId, readings = self.spool.peek(limit or self.batch_size)
+        if not readings:
+            return True
+        reason = None
+        try:
+            failed, rejected = self.sink.send_batch(readings)
+        except Exception as e:
+            reason = str(e)
+            if is_rejected(e):
+                failed, rejected = [], readings
+            else:
+                print("Spool replay failed, will try again later: {}".format(e))
+                failed, rejected = readings, []
+        if rejected and reason is None:
+            reason = "rejected by the sink"
+        if len(failed) == len(readings) and len(readings) > 1:
+            # Most likely the sink is down; leave the batch where it is rather than rewriting it.
+            return False
+        # Anything that didn't make it goes to the back of the spool, so a reading that keeps failing can't hold
+        # up the ones behind it, and rejected readings are taken out of the way for good.
+        self.spool.requeue(lastId, failed, rejected, reason)
+        sent = len(readings) - len(failed) - len(rejected)
+        self.replayed += sent
+        return sent > 0 or len(rejected) > 0
+
+    def _run(self):
+        backoff = self.interval
+        while not self.stopping.is_set():
+            if len(self.spool) == 0:
+                self.stopping.wait(self.interval)
+                continue
+            backlog = len(self.spool)
+            # Try a single reading first, so we don't push a whole batch at a sink that's still down.
+            reachable = self.drain_once(1)
+            while reachable and len(self.spool) > 0 and not self.stopping.is_set():
+                reachable = self.drain_once()
+            if len(self.spool) == 0:
+                print("Replayed {} spooled readings".format(backlog))
+                self.spool.compact()
+                backoff = self.interval
+            else:
+                self.stopping.wait(random.uniform(backoff / 2, backoff))
+                backoff = min(backoff * 2, self.max_backoff)
@@ -0,0 +1,96 @@
+#
+# Local cache of the newest timestamp already imported for each device ("watermark").
+#
+# Stored as a small JSON file of deviceId -> epoch seconds so that most uploads never have to ask InfluxDB
+# where each device is up to. Watermarks only ever move forward. The file is rewritten atomically, so a
+# crash mid-save leaves the previous version in place.
+#
+# If the data in InfluxDB is deleted, delete this file too, or rows older than the cached watermarks will
+# be skipped on the next import.
+#
+
+import json
+import threading
+
+from broodminder.jsonfile import save_json
+
+
+class WatermarkStore:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.watermarks = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return {str(k): float(v) for k, v in json.load(f).items()}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, AttributeError) as e:
+            print("Ignoring unreadable watermark file {}: {}".format(self.path, e))
+            return {}
+
+    def _save(self):
+        # Must be called with self.lock held.
+        save_json(self.path, self.watermarks)
+
+    def get(self, deviceId):
+        with self.lock:
+            return self.watermarks.get(deviceId)
+
+    def get_many(self, deviceIds) -> dict:
+        # Returns the watermarks we know about; devices we've never seen are left out.
+        with self.lock:
+            return {d: self.watermarks[d] for d in deviceIds if d in self.watermarks}
+
+    def all(self) -> dict:
+        with self.lock:
+            return dict(self.watermarks)
+
+    def update(self, watermarks: dict):
+        # Advance the given devices' watermarks (epoch seconds) and persist them.
+        with self.lock:
+            changed = False
+            for deviceId, timestamp in watermarks.items():
+                if timestamp is None:
+                    continue
+                timestamp = float(timestamp)
+                if timestamp > self.watermarks.get(deviceId, float("-inf")):
+                    self.watermarks[deviceId] = timestamp
+                    changed = True
+            if changed:
+                self._save()
+
+
+class WatermarkLookup:
+    # Watermarks for a single import: answered from the store where possible, with at most one call to
+    # fetch_latest() (which returns deviceId -> epoch seconds for every device) for devices the store doesn't
+    # know. Devices nobody knows about start from 0.
+    def __init__(self, store: WatermarkStore, fetch_latest):
+        self.store = store
+        self.fetch_latest = fetch_latest
+        self.known = store.all() if store is not None else {}
+        self.fetched = False
+
+    def get(self, deviceId) -> float:
+        timestamp = self.known.get(deviceId)
+        if timestamp is None:
+            if not self.fetched:
+                self._fetch()
+                timestamp = self.known.get(deviceId)
+            if timestamp is None:
+                timestamp = self.known[deviceId] = 0
+        return timestamp
+
+    def get_many(self, deviceIds) -> dict:
+        return {d: self.get(d) for d in deviceIds}
+
+    def _fetch(self):
+        self.fetched = True
+        latest = self.fetch_latest()
+        if self.store is not None:
+            self.store.update(latest)
+        for deviceId, timestamp in latest.items():
+            if timestamp > self.known.get(deviceId, float("-inf")):
+                self.known[deviceId] = timestamp
@@ -6,8 +6,10 @@
 # Has never been tested on a RaspberryPi, but might work.
 #
 
-from bgapi.module import BlueGigaClient
-import struct
+import argparse
+import os
+from broodminder.capture import KIND_BGAPI, CaptureWriter, ReplayBlueGigaClient
+from broodminder.decode import decode_bgapi
 
 #CLIENT_SERIAL = "COM4"
 CLIENT_SERIAL = "COM3"
@@ -24,8 +26,27 @@ def test_simple_scan(ble_client):
 
 
 if __name__ == "__main__":
-    ble_client = BlueGigaClient(port=CLIENT_SERIAL, baud=115200, timeout=0.1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="Serial port of the BlueGiga dongle", default=os.environ.get("BGAPI_PORT", CLIENT_SERIAL))
+    parser.add_argument("--capture", help="Also record the raw frames to this file, for --replay", default=os.environ.get("CAPTURE_FILE"))
+    parser.add_argument("--replay", help="Replay frames from a --capture file instead of using the dongle", default=os.environ.get("REPLAY_FILE"))
+    parser.add_argument("--replay-speed", help="Replay at this multiple of real time. 0 replays as fast as possible", type=float, default=float(os.environ.get("REPLAY_SPEED", 1.0)))
+    parser.add_argument("--replay-multiplier", help="Replay each frame as this many different devices", type=int, default=int(os.environ.get("REPLAY_MULTIPLIER", 1)))
+    args = parser.parse_args()
+
+    if args.replay:
+        ble_client = ReplayBlueGigaClient(args.replay, speed=args.replay_speed, multiplier=args.replay_multiplier)
+    else:
+        from bgapi.module import BlueGigaClient
+        ble_client = BlueGigaClient(port=args.port, baud=115200, timeout=0.1)
     ResponseArray = test_simple_scan(ble_client)
+    if args.capture:
+        capture = CaptureWriter(args.capture)
+        try:
+            for Response in ResponseArray:
+                capture.write(Response.data, kind=KIND_BGAPI)
+        finally:
+            capture.close()
     for Response in ResponseArray:
         print("\r\nResponse length:" + str(len(Response.data)))
         counter = 0
@@ -33,30 +54,15 @@ if __name__ == "__main__":
             # print(counter, str(ord(ch)))
             print(counter, str((ch)))
             counter += 1
-        if len(Response.data) > 30:
+        adv = decode_bgapi(Response.data)
+        if adv is not None:
             print("\r\nScale advertisement:")
-            print("IF Model#: {0}".format(struct.unpack_from("b", Response.data, offset=10)[0]))
-            print("FW Version: {0}.{1}".format(struct.unpack_from("b", Response.data, offset=12)[0], struct.unpack_from("b", Response.data, offset=11)[0]))
-            print("ID#: {0}".format(struct.unpack_from("b", Response.data, offset=13)[0]))
-            print("Battery level: {0}".format(struct.unpack_from("b", Response.data, offset=14)[0]))
-            print("Elapsed: {0}".format(struct.unpack_from("h", Response.data, offset=15)[0]))
-            TemperatureRawInt = struct.unpack_from("h", Response.data, offset=17)[0]
-            # From Datasheet SHT3x-DIS
-            TemperatureF = TemperatureRawInt * 315 / (2**16-1) - 49
-            print("Temperature(F): {0}".format(TemperatureF))
-            print("Humidity: {0}".format(struct.unpack_from("b", Response.data, offset=24)[0]))
-            if Response.data[25] == 255:
-                PrePendByteStr = '\xFF'
-            else:
-                PrePendByteStr = '\x00'
-            WeightLInt = struct.unpack_from(">i", PrePendByteStr + str(Response.data[25:]), offset=0)[0]
-            print("WeightL: {0}".format(WeightLInt))
-            if Response.data[28] == 255:
-                PrePendByteStr = '\xFF'
-            else:
-                PrePendByteStr = '\x00'
-            WeightRInt = struct.unpack_from(">i", PrePendByteStr + str(Response.data[28:]), offset=0)[0]
-            print("WeightR: {0}".format(WeightRInt))
-
-
-
+            print("IF Model#: {0}".format(adv.Model))
+            print("FW Version: {0}.{1}".format(adv.VersionMajor, adv.VersionMinor))
+            print("ID#: {0}".format(adv.Id))
+            print("Battery level: {0}".format(adv.BatteryPercent))
+            print("Elapsed: {0}".format(adv.SampleNumber))
+            print("Temperature(F): {0}".format(adv.TemperatureF))
+            print("Humidity: {0}".format(adv.HumidityPercent))
+            print("WeightL: {0}".format(adv.WeightL))
+            print("WeightR: {0}".format(adv.WeightR))
@@ -1,96 +1,272 @@
-from datetime import datetime
-import json
-import sqlite3
+from datetime import datetime, timezone
+import math
 import os
 import time
 import argparse
+import tempfile
 import influxdb_client
 import influxdb_client.client.query_api
 from influxdb_client.client.write_api import SYNCHRONOUS, WritePrecision
 import flask
 from flask import jsonify, request
+from broodminder.delta import ENCODINGS, OffsetMismatch, UnknownUpload, UploadSessions, read_rows
+from broodminder.influx import MEASUREMENT, BatchWriter, reading_line
+from broodminder.jobs import JobQueue, QueueFull
+from broodminder.metrics import CONTENT_TYPE, PROFILER, REGISTRY
+from broodminder.query_cache import ALL_DEVICES, QueryCache
+from broodminder.phone_db import open_readonly, stream_readings
+from broodminder.rollup import RollupEngine
+from broodminder.watermarks import WatermarkLookup, WatermarkStore
 
 UPLOAD_FOLDER = "/tmp"
-TMP_FILENAME = "broodminder_upload.tmp"
-
-# The sqlite DB stores the temp in F, so this class will convert it.
-class BroodMinderResult:
-    def __init__(self, deviceId, sampleNumber, timestamp, temperatureF, humidityPercent, batteryPercent, weight = None):
-        self.DeviceId = deviceId
-        self.SampleNumber = sampleNumber
-        self.Timestamp = timestamp
-        self.TemperatureF = temperatureF
-        self.TemperatureC = (temperatureF - 32) * 5 / 9
-        self.HumidityPercent = humidityPercent
-        self.BatteryPercent = batteryPercent
-        self.Weight = weight # TH devices don't have weight, so by default this will be None.
-        # The MyBroodMinder API expects the temperature in F :(
+SERIES_MEASUREMENTS = {'raw': MEASUREMENT, '1h': MEASUREMENT + '_1h', '1d': MEASUREMENT + '_1d'}
+UPLOAD_PREFIX = "broodminder_upload_"
+# Recompute the rollups an import has moved past once this many of its buckets are complete.
+ROLLUP_FLUSH_BUCKETS = 2000
+
+IMPORT_ROWS = REGISTRY.counter("broodminder_import_rows_total", "Rows imported from uploaded databases")
+IMPORT_ROWS_PER_SEC = REGISTRY.gauge("broodminder_import_rows_per_second", "Rows per second of the last import")
+UPLOADS = REGISTRY.counter("broodminder_uploads_total", "Uploads received, by outcome", ["outcome"])
+
+# Raised when an import can't be completed. `result` is reported back in the job status.
+class UploadImportError(Exception):
+    def __init__(self, message, result = None):
+        super().__init__(message)
+        self.result = result
 
 class BroodMinderInfluxClient:
-    def __init__(self, write_api: influxdb_client.WriteApi, query_api: influxdb_client.QueryApi, org, bucket):
+    def __init__(self, write_api: influxdb_client.WriteApi, query_api: influxdb_client.QueryApi, org, bucket,
+                 batch_size=5000, flush_interval=1.0, max_in_flight=4, max_retries=5):
         self.write_api = write_api
         self.org = org
         self.bucket = bucket
         self.query_api = query_api
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
 
-    def write(self, data: BroodMinderResult):
-        p = influxdb_client.Point("broodminder").tag("deviceId", data.DeviceId).field("temperature", data.TemperatureC).field(
-        "humidity", data.HumidityPercent).field("battery", data.BatteryPercent).field("sampleNumber", data.SampleNumber).time(
-        data.Timestamp, write_precision=WritePrecision.S)
+    def writeLines(self, lines: str):
+        self.write_api.write(self.bucket, self.org, record=lines, write_precision=WritePrecision.S)
 
-        self.write_api.write(self.bucket, self.org, record=p)
-    
-    def getLatestRecordTimestamp(self, deviceId: str) -> datetime:
+    # Write a list of lines synchronously, batch_size at a time. Raises on the first failed write.
+    def writeLineBatches(self, lines: list):
+        for i in range(0, len(lines), self.batch_size):
+            self.writeLines("\n".join(lines[i:i + self.batch_size]))
+
+    # Bulk writer for imports. Call add() with line protocol from reading_line() and close() when done.
+    def batchWriter(self) -> BatchWriter:
+        return BatchWriter(self.writeLines, batch_size=self.batch_size, flush_interval=self.flush_interval,
+                           max_in_flight=self.max_in_flight, max_retries=self.max_retries)
+
+    # Newest temperature timestamp for every device, in a single query. Returns deviceId -> datetime.
+    def getLatestRecordTimestamps(self) -> dict:
         query = """from(bucket: "{0}")
                     |> range(start: -100y)
                     |> filter(fn: (r) => r["_measurement"] == "broodminder")
                     |> filter(fn: (r) => r["_field"] == "temperature")
-                    |> filter(fn: (r) => r["deviceId"] == "{1}")
-                    |> last()""".format(self.bucket, deviceId)
+                    |> group(columns: ["deviceId"])
+                    |> last()
+                    |> keep(columns: ["deviceId", "_time"])""".format(self.bucket)
         records = self.query_api.query_stream(query)
-        for r in records: # There should only be 1 result anyway
-            return r["_time"]
-
-
-# Read records from uploaded db file and send to InfluxDB. Not even slightly thread-safe.
-def handle_uploaded_file(file, client: BroodMinderInfluxClient):
-    file.save(os.path.join(UPLOAD_FOLDER, TMP_FILENAME))
-
-    db = sqlite3.connect(os.path.join(UPLOAD_FOLDER, TMP_FILENAME))
-    db.row_factory = sqlite3.Row # Enable named columns
-
-    cur_devices = db.cursor()
-    cur_devices.execute("SELECT DISTINCT DeviceId FROM StoredSensorReading")
-    upload_results = {}
-    for deviceRow in cur_devices:
-        deviceId = deviceRow['DeviceId']
-        last_record_timestamp = client.getLatestRecordTimestamp(deviceId)
-        if last_record_timestamp is None: # if the db is empty, use the earliest posssible timestamp.
-            last_record_timestamp = datetime.fromtimestamp(0)
-
-        cur = db.cursor()
-        cur.execute("SELECT * FROM StoredSensorReading WHERE DeviceId = ? AND timestamp > ?", (deviceId, last_record_timestamp.timestamp()))
-
-        for row in cur:
-            result = BroodMinderResult(deviceId, row['Sample'], row['Timestamp'], row['Temperature'], row['Humidity'], row['Battery'])
-            client.write(result)
-            last_record_timestamp = row['Timestamp']
-        cur.close()
-        upload_results[deviceId] = last_record_timestamp
-    cur_devices.close()
-
-    db.close()
-    os.unlink(os.path.join(UPLOAD_FOLDER, TMP_FILENAME)) # Delete file now that we're done
-    return ok('Data imported', upload_results)
-
-def error(message, code = 400):
-    resp = jsonify({'message': message})
+        return {r["deviceId"]: r["_time"] for r in records}
+
+    # Newest value of every field for a device, or None. Fields aren't always written together (weight only comes
+    # from scales), so each one is reported with its own time:
+    # {'time': newest epoch seconds, field: value, ..., 'times': {field: epoch seconds, ...}}
+    def getLatestReading(self, deviceId: str) -> dict:
+        query = """from(bucket: "{0}")
+                    |> range(start: -100y)
+                    |> filter(fn: (r) => r["_measurement"] == "broodminder")
+                    |> filter(fn: (r) => r["deviceId"] == params.deviceId)
+                    |> last()""".format(self.bucket)
+        latest = None
+        for r in self.query_api.query_stream(query, params={"deviceId": deviceId}):
+            if latest is None:
+                latest = {'time': None, 'times': {}}
+            fieldTime = r["_time"].timestamp()
+            latest[r["_field"]] = r["_value"]
+            latest['times'][r["_field"]] = fieldTime
+            if latest['time'] is None or fieldTime > latest['time']:
+                latest['time'] = fieldTime
+        return latest
+
+    # A device's readings between two epoch second timestamps, oldest first. measurement is "broodminder" for
+    # the raw readings, or one of the rollup measurements.
+    def getSeries(self, deviceId: str, start: float, stop: float, measurement = "broodminder") -> list:
+        query = """from(bucket: "{0}")
+                    |> range(start: time(v: params.start), stop: time(v: params.stop))
+                    |> filter(fn: (r) => r["_measurement"] == params.measurement)
+                    |> filter(fn: (r) => r["deviceId"] == params.deviceId)
+                    |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+                    |> sort(columns: ["_time"])""".format(self.bucket)
+        params = {"deviceId": deviceId, "measurement": measurement, "start": rfc3339(start), "stop": rfc3339(stop)}
+        return [self._fields(r) for r in self.query_api.query_stream(query, params=params)]
+
+    @staticmethod
+    def _fields(record) -> dict:
+        # A pivoted Flux record as {'time': epoch seconds, field: value, ...}, without Flux's own columns.
+        reading = {'time': record["_time"].timestamp()}
+        for key, value in record.values.items():
+            if not key.startswith("_") and key not in ("result", "table", "deviceId"):
+                reading[key] = value
+        return reading
+
+
+def rfc3339(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Where each device is up to: the local watermark store first, and only if a device isn't in there,
+# one query to InfluxDB for all of them.
+def watermark_lookup(client: BroodMinderInfluxClient, watermarks: WatermarkStore = None) -> WatermarkLookup:
+    return WatermarkLookup(watermarks, lambda: {d: t.timestamp() for d, t in client.getLatestRecordTimestamps().items()})
+
+# Parse an optional epoch seconds query argument. Raises ValueError if it's there but isn't a finite number.
+def epoch_arg(name, default) -> float:
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        timestamp = float(value)
+    except ValueError:
+        raise ValueError('{} must be a number of epoch seconds'.format(name))
+    if not math.isfinite(timestamp):
+        raise ValueError('{} must be a number of epoch seconds'.format(name))
+    return timestamp
+
+# Save an uploaded file to its own spool file, so concurrent uploads can't overwrite each other.
+def spool_upload(file) -> str:
+    fd, path = tempfile.mkstemp(prefix=UPLOAD_PREFIX, suffix=".sqlite", dir=UPLOAD_FOLDER)
+    os.close(fd)
+    file.save(path)
+    return path
+
+# Send rows newer than each device's watermark to InfluxDB. `chunks` yields lists of
+# (DeviceId, Sample, Timestamp, Temperature (F), Humidity, Battery) tuples; rows go straight to line protocol.
+# If `rollups` is given, the hourly/daily rollup buckets the rows land in are recomputed from the raw data: the
+# ones the import has moved past as it goes, and the rest once every row is written. A rollup failure doesn't fail
+# the import, as the raw rows are already in InfluxDB; it's reported as 'rollup_error' and the buckets are retried
+# by a later import.
+# If `cache` is given, cached read API results for the devices that got new rows are dropped.
+def import_rows(job, chunks, client: BroodMinderInfluxClient, watermarks: WatermarkStore = None,
+                rollups: RollupEngine = None, cache: QueryCache = None) -> dict:
+    writer = None
+    rollup_batch = rollups.batch() if rollups is not None else None
+    rollup_error = None
+    try:
+        lookup = watermark_lookup(client, watermarks)
+        starting = {} # deviceId -> watermark before this import
+        upload_results = {} # deviceId -> newest timestamp after this import
+        writer = client.batchWriter()
+        rows_read = 0
+        rows = 0
+        job.report(rows_read = 0, rows = 0)
+
+        for chunk in chunks:
+            imported = [] # (deviceId, timestamp) for the rollups
+            for (deviceId, sample, timestamp, temperatureF, humidity, battery) in chunk:
+                last_record_timestamp = starting.get(deviceId)
+                if last_record_timestamp is None:
+                    last_record_timestamp = starting[deviceId] = lookup.get(deviceId)
+                    upload_results[deviceId] = last_record_timestamp
+                if timestamp <= last_record_timestamp:
+                    continue
+                # The sqlite DB stores the temp in F.
+                temperatureC = (temperatureF - 32) * 5 / 9
+                writer.add(reading_line(deviceId, temperatureC, humidity, battery, sample, timestamp))
+                if rollup_batch is not None:
+                    imported.append((deviceId, timestamp))
+                if timestamp > upload_results[deviceId]:
+                    upload_results[deviceId] = timestamp
+                rows += 1
+            if imported:
+                deviceIds, timestamps = zip(*imported)
+                rollup_batch.add(deviceIds, timestamps)
+                # Once a flush has failed, leave the rest until the end rather than retrying on every chunk.
+                if rollup_error is None and rollup_batch.complete() >= ROLLUP_FLUSH_BUCKETS:
+                    # The raw rows have to be in InfluxDB before their buckets can be recomputed.
+                    writer.drain()
+                    rollup_error = flush_rollups(lambda: rollups.flush(rollup_batch, client.writeLineBatches, complete_only=True))
+            rows_read += len(chunk)
+            job.report(rows_read = rows_read, rows = rows, devices = len(starting))
+        stats = writer.close()
+        errors = writer.errors
+        writer = None
+    finally:
+        if writer is not None: # Something went wrong part-way through, don't leave the writer's threads behind.
+            writer.close()
+
+    if stats['failed_rows'] > 0:
+        raise UploadImportError('Failed to write {} rows to InfluxDB: {}'.format(stats['failed_rows'], errors[-1]), {'stats': stats})
+    IMPORT_ROWS.inc(stats['rows'])
+    IMPORT_ROWS_PER_SEC.set(stats['rows_per_sec'])
+    # Only move the watermarks on once every row is safely in InfluxDB.
+    if watermarks is not None:
+        watermarks.update(upload_results)
+    if cache is not None:
+        cache.invalidate(d for d, t in upload_results.items() if t > starting[d])
+    result = {'message': 'Data imported', 'data': upload_results, 'stats': stats}
+    if rollup_batch is not None:
+        rollup_error = flush_rollups(lambda: rollups.flush(rollup_batch, client.writeLineBatches))
+        # Whatever failed is kept with the engine's live buckets, and retried by a later import.
+        rollups.defer(rollup_batch)
+        if rollup_error is None:
+            rollup_error = flush_rollups(lambda: rollups.flush_live(client.writeLineBatches))
+        if rollup_error is not None:
+            result['rollup_error'] = rollup_error
+    return result
+
+# Run a rollup flush. Returns None, or the error message if it failed; failed buckets are put back by the engine.
+def flush_rollups(flush) -> str:
+    try:
+        flush()
+    except Exception as e:
+        print('Failed to write rollups to InfluxDB: {}'.format(e))
+        return str(e)
+    return None
+
+# Import a spooled phone db file. Runs on a job queue worker; the file is deleted when done.
+# The file is read in a single streaming pass.
+def handle_uploaded_file(job, path, client: BroodMinderInfluxClient, watermarks: WatermarkStore = None,
+                         rollups: RollupEngine = None, cache: QueryCache = None, chunk_size = 5000) -> dict:
+    try:
+        db = open_readonly(path)
+        try:
+            return import_rows(job, stream_readings(db, chunk_size), client, watermarks, rollups, cache)
+        finally:
+            db.close()
+    finally:
+        os.unlink(path) # Delete file now that we're done
+
+# Import a finished delta upload (compressed NDJSON rows, see broodminder/delta.py). Runs on a job queue worker;
+# the file is deleted when done.
+def handle_delta_upload(job, path, encoding, client: BroodMinderInfluxClient, watermarks: WatermarkStore = None,
+                        rollups: RollupEngine = None, cache: QueryCache = None, chunk_size = 5000) -> dict:
+    try:
+        return import_rows(job, read_rows(path, encoding, chunk_size), client, watermarks, rollups, cache)
+    except ValueError as e:
+        raise UploadImportError('Upload is malformed: {}'.format(e))
+    finally:
+        os.unlink(path)
+
+# Import jobs are handler(job, *args); this runs whichever import the upload needs.
+def run_import(job, handler, *args):
+    return handler(job, *args)
+
+def error(message, code = 400, stats = None):
+    body = {'message': message}
+    if stats is not None:
+        body['stats'] = stats
+    resp = jsonify(body)
     resp.status_code = code
     return resp
 
-def ok(message, data = None):
-    resp = jsonify({'message': message, 'data': data})
-    resp.status_code = 200
+def ok(message, data = None, stats = None, code = 200):
+    body = {'message': message, 'data': data}
+    if stats is not None:
+        body['stats'] = stats
+    resp = jsonify(body)
+    resp.status_code = code
     return resp
 
 if __name__ == "__main__":
@@ -101,6 +277,21 @@ if __name__ == "__main__":
     parser.add_argument("--influxdb-org", help="InfluxDB Organisation, needed if output=influxdb", default=os.environ.get("INFLUXDB_ORG"))
     parser.add_argument("--influxdb-bucket", help="InfluxDB Bucket, needed if output=influxdb", default=os.environ.get("INFLUXDB_BUCKET"))
     parser.add_argument("--influxdb-token", help="InfluxDB Auth Token, needed if output=influxdb", default=os.environ.get("INFLUXDB_TOKEN"))
+    parser.add_argument("--batch-size", help="Number of rows per InfluxDB write", type=int, default=int(os.environ.get("INFLUXDB_BATCH_SIZE", 5000)))
+    parser.add_argument("--flush-interval", help="Seconds before a partial batch is written anyway", type=float, default=float(os.environ.get("INFLUXDB_FLUSH_INTERVAL", 1.0)))
+    parser.add_argument("--max-in-flight", help="Maximum number of concurrent InfluxDB writes", type=int, default=int(os.environ.get("INFLUXDB_MAX_IN_FLIGHT", 4)))
+    parser.add_argument("--max-retries", help="Times to retry a failed batch before giving up", type=int, default=int(os.environ.get("INFLUXDB_MAX_RETRIES", 5)))
+    parser.add_argument("--watermark-file", help="Local cache of the newest imported timestamp per device. Set to an empty string to always ask InfluxDB",
+                        default=os.environ.get("WATERMARK_FILE", os.path.join(UPLOAD_FOLDER, "broodminder_watermarks.json")))
+    parser.add_argument("--disable-rollups", help="Don't write hourly/daily rollups to the broodminder_1h and broodminder_1d measurements", action="store_true",
+                        default=os.environ.get("DISABLE_ROLLUPS", "").lower() in ("1", "true", "yes"))
+    parser.add_argument("--upload-workers", help="Number of uploads to import in parallel", type=int, default=int(os.environ.get("UPLOAD_WORKERS", 2)))
+    parser.add_argument("--upload-queue-size", help="Maximum number of uploads waiting to be imported", type=int, default=int(os.environ.get("UPLOAD_QUEUE_SIZE", 16)))
+    parser.add_argument("--cache-size", help="Maximum number of read API results to cache", type=int, default=int(os.environ.get("CACHE_SIZE", 1024)))
+    parser.add_argument("--cache-ttl", help="Seconds to cache read API results for. Imports through /upload invalidate them straight away",
+                        type=float, default=float(os.environ.get("CACHE_TTL", 60)))
+    parser.add_argument("--enable-profiling", help="Allow profiling windows to be started with POST /debug/profile?seconds=N", action="store_true",
+                        default=os.environ.get("ENABLE_PROFILING", "").lower() in ("1", "true", "yes"))
     args = parser.parse_args()
 
     influxdb_url = getattr(args, "influxdb_url", None)
@@ -120,6 +311,12 @@ if __name__ == "__main__":
     client = influxdb_client.InfluxDBClient(url=influxdb_url, token=influxdb_token, org=influxdb_org)
     influxdb_write_api = client.write_api(write_options=SYNCHRONOUS)
     influxdb_query_api = client.query_api()
+    watermarks = WatermarkStore(args.watermark_file) if args.watermark_file else None
+    rollups = None if args.disable_rollups else RollupEngine(influxdb_query_api, influxdb_bucket)
+    cache = QueryCache(max_entries=args.cache_size, ttl=args.cache_ttl)
+    read_client = BroodMinderInfluxClient(influxdb_write_api, influxdb_query_api, influxdb_org, influxdb_bucket)
+    sessions = UploadSessions(UPLOAD_FOLDER)
+    upload_jobs = JobQueue(run_import, workers=args.upload_workers, max_queued=args.upload_queue_size)
 
     print("Starting Flask")
 
@@ -136,7 +333,135 @@ if __name__ == "__main__":
         if 'file' not in request.files:
             return error('No file uploaded')
         file = request.files['file']
-        client = BroodMinderInfluxClient(influxdb_write_api, influxdb_query_api, influxdb_org, influxdb_bucket)
-        return handle_uploaded_file(file, client)
+        client = BroodMinderInfluxClient(influxdb_write_api, influxdb_query_api, influxdb_org, influxdb_bucket,
+                                         args.batch_size, args.flush_interval, args.max_in_flight, args.max_retries)
+        path = spool_upload(file)
+        try:
+            job = upload_jobs.submit(handle_uploaded_file, path, client, watermarks, rollups, cache)
+        except QueueFull:
+            os.unlink(path)
+            UPLOADS.inc(outcome='rejected')
+            return error('Too many uploads waiting to be imported, try again later', 503)
+        UPLOADS.inc(outcome='queued')
+        return ok('Upload queued', {'job': job.id}, code = 202)
+
+    # Delta uploads, see broodminder/delta.py for the protocol.
+    @app.route('/watermarks', methods=['GET'])
+    def get_watermarks():
+        # What the server has already, so the client only needs to send newer rows.
+        latest = cache.get(('watermarks',), ALL_DEVICES, lambda: {d: t.timestamp() for d, t in read_client.getLatestRecordTimestamps().items()})
+        known = dict(latest)
+        if watermarks is not None:
+            for deviceId, timestamp in watermarks.all().items():
+                known[deviceId] = max(timestamp, known.get(deviceId, timestamp))
+        return ok('{} devices'.format(len(known)), {'watermarks': known, 'encodings': list(ENCODINGS)})
+
+    @app.route('/uploads', methods=['POST'])
+    def create_upload():
+        body = request.get_json(silent=True) or {}
+        try:
+            upload_id = sessions.create(body.get('encoding', 'gzip'))
+        except ValueError as e:
+            return error(str(e))
+        return ok('Upload started', {'upload': upload_id, 'offset': 0}, code = 201)
+
+    @app.route('/uploads/<upload_id>', methods=['GET'])
+    def upload_offset(upload_id):
+        try:
+            return ok('Upload in progress', {'upload': upload_id, 'offset': sessions.offset(upload_id)})
+        except UnknownUpload:
+            return error('Unknown upload', 404)
+
+    @app.route('/uploads/<upload_id>', methods=['PUT'])
+    def upload_chunk(upload_id):
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return error('offset is required')
+        try:
+            new_offset = sessions.append(upload_id, offset, request.stream)
+        except UnknownUpload:
+            return error('Unknown upload', 404)
+        except OffsetMismatch as e:
+            return ok(str(e), {'upload': upload_id, 'offset': e.offset}, code = 409)
+        return ok('Chunk received', {'upload': upload_id, 'offset': new_offset})
+
+    @app.route('/uploads/<upload_id>/complete', methods=['POST'])
+    def complete_upload(upload_id):
+        body = request.get_json(silent=True) or {}
+        try:
+            path, encoding = sessions.finish(upload_id, body.get('sha256'))
+        except UnknownUpload:
+            return error('Unknown upload', 404)
+        except ValueError as e:
+            return error(str(e), 422)
+        client = BroodMinderInfluxClient(influxdb_write_api, influxdb_query_api, influxdb_org, influxdb_bucket,
+                                         args.batch_size, args.flush_interval, args.max_in_flight, args.max_retries)
+        try:
+            job = upload_jobs.submit(handle_delta_upload, path, encoding, client, watermarks, rollups, cache)
+        except QueueFull:
+            # Keep the session so the client can just try completing it again.
+            os.replace(path, path + '.part')
+            UPLOADS.inc(outcome='rejected')
+            return error('Too many uploads waiting to be imported, try again later', 503)
+        UPLOADS.inc(outcome='queued')
+        return ok('Upload queued', {'job': job.id}, code = 202)
+
+    @app.route('/jobs/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        job = upload_jobs.get(job_id)
+        if job is None:
+            return error('Unknown job', 404)
+        return ok('Job {}'.format(job.status), job.to_dict())
+
+    # Read API. Results are cached (see broodminder/query_cache.py), so polling these doesn't hit InfluxDB.
+
+    @app.route('/devices', methods=['GET'])
+    def devices():
+        latest = cache.get(('devices',), ALL_DEVICES, read_client.getLatestRecordTimestamps)
+        data = [{'deviceId': d, 'lastSeen': t.timestamp()} for d, t in sorted(latest.items())]
+        return ok('{} devices'.format(len(data)), data)
+
+    @app.route('/devices/<device_id>/latest', methods=['GET'])
+    def device_latest(device_id):
+        reading = cache.get(('latest', device_id), device_id, lambda: read_client.getLatestReading(device_id))
+        if reading is None:
+            return error('Unknown device', 404)
+        return ok('Latest reading', reading)
+
+    @app.route('/devices/<device_id>/series', methods=['GET'])
+    def device_series(device_id):
+        # from/to are epoch seconds, defaulting to the last day. bucket is raw, 1h or 1d.
+        now = time.time()
+        try:
+            start = epoch_arg('from', now - 86400)
+            stop = epoch_arg('to', now)
+        except ValueError as e:
+            return error(str(e))
+        bucket = request.args.get('bucket', 'raw')
+        if bucket not in SERIES_MEASUREMENTS:
+            return error('bucket must be one of {}'.format(', '.join(SERIES_MEASUREMENTS)))
+        if stop <= start:
+            return error('to must be after from')
+        # Open-ended requests are rounded to the minute so repeated polls share a cache entry.
+        if 'to' not in request.args:
+            stop = stop - stop % 60 + 60
+            if 'from' not in request.args:
+                start = stop - 86400
+        points = cache.get(('series', device_id, bucket, start, stop), device_id,
+                           lambda: read_client.getSeries(device_id, start, stop, SERIES_MEASUREMENTS[bucket]))
+        return ok('{} points'.format(len(points)), {'deviceId': device_id, 'bucket': bucket, 'from': start, 'to': stop, 'points': points})
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return flask.Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    if args.enable_profiling:
+        @app.route('/debug/profile', methods=['POST'])
+        def profile():
+            seconds = request.args.get('seconds', 60, type=float)
+            path = os.path.join(UPLOAD_FOLDER, 'broodminder_import_{}.prof'.format(int(time.time())))
+            if not PROFILER.start(seconds, path):
+                return error('A profile is already running', 409)
+            return ok('Profiling for {} seconds'.format(seconds), {'output': path})
 
     app.run(host='0.0.0.0')
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# Reference client for delta uploads to sqlite_to_influxdb.py (see broodminder/delta.py for the protocol).
+#
+# Asks the server where each device is up to, compresses just the newer rows from the phone app's database and
+# uploads them in chunks. If the upload is interrupted, run it again: the prepared payload and upload id are
+# kept next to the state file, and the upload carries on from wherever the server got to.
+#
+# Usage:
+#   python3 sync_client.py --server http://pi.local:5000 --db BroodMinder.sqlite
+#
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+from broodminder.delta import ENCODINGS, write_rows
+from broodminder.jsonfile import save_json
+from broodminder.phone_db import open_readonly, stream_readings
+
+
+class SyncError(Exception):
+    pass
+
+
+def call(method, url, body=None, data=None, timeout=60):
+    # Returns (status, parsed JSON response). body is sent as JSON, data as raw bytes.
+    headers = {}
+    if body is not None:
+        data = json.dumps(body).encode("utf-8")
+        headers["Content-Type"] = "application/json"
+    elif data is not None:
+        headers["Content-Type"] = "application/octet-stream"
+    req = urllib.request.Request(url, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, json.load(resp)
+    except urllib.error.HTTPError as e:
+        try:
+            return e.code, json.load(e)
+        except ValueError:
+            return e.code, {"message": e.reason}
+
+
+def sha256_file(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def prepare(server, db_path, payload_path) -> dict:
+    # Write the rows the server doesn't have yet to payload_path. Returns the upload state, or None if there's nothing new.
+    status, resp = call("GET", server + "/watermarks")
+    if status != 200:
+        raise SyncError("Couldn't get watermarks: {}".format(resp.get("message")))
+    watermarks = resp["data"]["watermarks"]
+    encoding = next((e for e in ENCODINGS if e in resp["data"]["encodings"]), "gzip")
+
+    # The app may be writing to it right now, so read it with locking and through its WAL.
+    db = open_readonly(db_path, immutable=False)
+    try:
+        rows = (row for chunk in stream_readings(db) for row in chunk if row[2] > watermarks.get(row[0], 0))
+        count = write_rows(payload_path, rows, encoding)
+    finally:
+        db.close()
+    if count == 0:
+        os.unlink(payload_path)
+        return None
+    print("{} new rows, {} bytes compressed with {}".format(count, os.path.getsize(payload_path), encoding))
+    return {"payload": payload_path, "encoding": encoding, "rows": count, "sha256": sha256_file(payload_path), "upload": None}
+
+
+def upload(server, state, save_state, chunk_size, max_retries=5):
+    size = os.path.getsize(state["payload"])
+    offset = None
+    if state["upload"] is not None:
+        status, resp = call("GET", "{}/uploads/{}".format(server, state["upload"]))
+        if status == 200:
+            offset = resp["data"]["offset"]
+            print("Resuming upload {} at {} of {} bytes".format(state["upload"], offset, size))
+    if offset is None:
+        status, resp = call("POST", server + "/uploads", body={"encoding": state["encoding"]})
+        if status != 201:
+            raise SyncError("Couldn't start upload: {}".format(resp.get("message")))
+        state["upload"] = resp["data"]["upload"]
+        save_state(state)
+        offset = 0
+
+    url = "{}/uploads/{}".format(server, state["upload"])
+    retries = 0
+    with open(state["payload"], "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            try:
+                status, resp = call("PUT", "{}?offset={}".format(url, offset), data=chunk)
+            except OSError as e:
+                status, resp = None, {"message": str(e)}
+            if status in (200, 409):
+                # On 409 the server tells us where it's really up to.
+                offset = resp["data"]["offset"]
+                retries = 0
+                print("Uploaded {} of {} bytes".format(offset, size))
+                continue
+            retries += 1
+            if retries > max_retries:
+                raise SyncError("Upload failed at {} bytes, run again to resume: {}".format(offset, resp.get("message")))
+            time.sleep(min(2 ** retries, 60))
+
+    status, resp = call("POST", url + "/complete", body={"sha256": state["sha256"]})
+    if status == 422:
+        # What the server got doesn't match the payload, so send it all again next time.
+        state["upload"] = None
+        save_state(state)
+    if status != 202:
+        raise SyncError("Couldn't complete upload: {}".format(resp.get("message")))
+    return resp["data"]["job"]
+
+
+def wait_for_job(server, jobId, poll_interval=2.0):
+    while True:
+        status, resp = call("GET", "{}/jobs/{}".format(server, jobId))
+        if status != 200:
+            raise SyncError("Couldn't get import status: {}".format(resp.get("message")))
+        job = resp["data"]
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", help="Import server URL, e.g. http://localhost:5000", default=os.environ.get("SYNC_SERVER", "http://localhost:5000"))
+    parser.add_argument("--db", help="The BroodMinder phone app's sqlite database", required=True)
+    parser.add_argument("--state-file", help="Where to keep track of an unfinished upload", default=os.environ.get("SYNC_STATE_FILE", "broodminder_sync.json"))
+    parser.add_argument("--chunk-size", help="Bytes per upload request", type=int, default=int(os.environ.get("SYNC_CHUNK_SIZE", 1024 * 1024)))
+    parser.add_argument("--no-wait", help="Don't wait for the server to finish importing", action="store_true")
+    args = parser.parse_args()
+    server = args.server.rstrip("/")
+
+    def save_state(state):
+        # Atomic, so a crash mid-save can't leave a state file that stops the upload resuming.
+        save_json(args.state_file, state)
+
+    state = None
+    if os.path.exists(args.state_file):
+        with open(args.state_file) as f:
+            state = json.load(f)
+        if not os.path.exists(state["payload"]):
+            state = None
+    if state is None:
+        state = prepare(server, args.db, args.state_file + ".payload")
+        if state is None:
+            print("Nothing new to upload")
+            raise SystemExit(0)
+        save_state(state)
+
+    jobId = upload(server, state, save_state, args.chunk_size)
+    # The server has the whole upload now, so there's nothing left to resume.
+    os.unlink(state["payload"])
+    os.unlink(args.state_file)
+    print("Upload complete, import job {}".format(jobId))
+
+    if not args.no_wait:
+        job = wait_for_job(server, jobId)
+        if job["status"] == "failed":
+            raise SystemExit("Import failed: {}".format(job["error"]))
+        print("Imported {} rows".format((job["result"] or {}).get("stats", {}).get("rows")))
@@ -0,0 +1,8 @@
+#
+# The tests import the broodminder package and the scripts from the directory above, however pytest is run.
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
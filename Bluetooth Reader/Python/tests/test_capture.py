@@ -0,0 +1,73 @@
+import pytest
+
+from broodminder.capture import (KIND_ADVERTISEMENT, KIND_BGAPI, CaptureWriter, ReplayBlueGigaClient, ReplayScanner,
+                                 read_capture)
+
+
+def capture_file(tmp_path, frames=3):
+    path = str(tmp_path / "scan.cap")
+    writer = CaptureWriter(path)
+    for i in range(frames):
+        writer.write(bytes([0x8D, 0x02, i]), "aa:bb:cc:dd:ee:{:02x}".format(i), -60 - i, "43:01:0{}".format(i),
+                     timestamp=1000.0 + i)
+    writer.write(b"\x80\x00", kind=KIND_BGAPI, timestamp=1010.0)
+    writer.close()
+    return path
+
+
+class Delegate:
+    def __init__(self):
+        self.seen = []
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        self.seen.append((dev.addr, dev.rssi, dev.getValueText(9), dev.getValue(255)))
+
+
+def test_frames_round_trip(tmp_path):
+    frames = list(read_capture(capture_file(tmp_path)))
+    assert len(frames) == 4
+    assert frames[1] == (1001.0, KIND_ADVERTISEMENT, "aa:bb:cc:dd:ee:01", -61, "43:01:01", b"\x8d\x02\x01")
+    assert frames[3].Kind == KIND_BGAPI and frames[3].Name == ""
+
+
+def test_truncated_capture_stops_at_the_last_whole_record(tmp_path):
+    path = capture_file(tmp_path)
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 1)
+    assert len(list(read_capture(path))) == 3
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / "not.cap"
+    path.write_bytes(b"SQLite format 3\x00")
+    with pytest.raises(ValueError):
+        list(read_capture(str(path)))
+
+
+def test_replay_scanner_hands_advertisements_to_the_delegate(tmp_path):
+    delegate = Delegate()
+    scanner = ReplayScanner(capture_file(tmp_path), speed=0).withDelegate(delegate)
+    scanner.scan(10)
+    assert scanner.finished
+    assert delegate.seen[0] == ("aa:bb:cc:dd:ee:00", -60, "43:01:00", b"\x8d\x02\x00")
+    assert len(delegate.seen) == 3  # The BlueGiga frame is left for ReplayBlueGigaClient.
+
+
+def test_multiplied_copies_are_distinct_devices(tmp_path):
+    delegate = Delegate()
+    ReplayScanner(capture_file(tmp_path, frames=1), speed=0, multiplier=3).withDelegate(delegate).scan(10)
+    assert [name for _, _, name, _ in delegate.seen] == ["43:01:00", "43:01:00-1", "43:01:00-2"]
+    assert len({addr for addr, _, _, _ in delegate.seen}) == 3
+
+
+def test_real_time_replay_stops_at_the_scan_timeout(tmp_path):
+    # Frames are a second apart, so only the first is due.
+    scanner = ReplayScanner(capture_file(tmp_path), speed=1).withDelegate(Delegate())
+    scanner.scan(0.2)
+    assert len(scanner.delegate.seen) == 1 and not scanner.finished
+
+
+def test_bgapi_replay(tmp_path):
+    client = ReplayBlueGigaClient(capture_file(tmp_path), speed=0)
+    client.reset_ble_state()
+    assert [r.data for r in client.scan_all(timeout=1)] == [b"\x80\x00"]
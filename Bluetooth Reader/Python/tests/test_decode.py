@@ -0,0 +1,61 @@
+import struct
+
+import pytest
+
+from benchmarks import synth
+from broodminder.decode import ADV_LENGTH, decode, decode_batch, decode_bgapi
+
+V1 = bytes.fromhex("8d022b01010070c502990b1e00000000003f")
+V2 = bytes.fromhex("8d022b01050070c502990b1e00000000003f")
+
+
+def test_decode_picks_layout_from_major_version():
+    assert decode(V1).Weight is None
+    assert decode(V1).TemperatureC == pytest.approx(0x0b99 / 65536 * 165 - 40)
+    assert decode(V2).TemperatureC == pytest.approx((0x0b99 - 5000) / 100)
+
+
+def test_decode_rejects_other_and_short_data():
+    assert decode(None) is None
+    assert decode(b"\x4c\x00" + V2[2:]) is None
+    assert decode(V2[:ADV_LENGTH - 1]) is None
+
+
+def test_decode_batch_matches_decode():
+    np = pytest.importorskip("numpy")
+    frames = [data for _, data in synth.make_advertisements(500, devices=20)]
+    frames += [V1, V2, V2[:10], b"", None, b"\x00" * ADV_LENGTH]
+    batch = decode_batch(frames)
+    for i, frame in enumerate(frames):
+        adv = decode(frame)
+        assert bool(batch["valid"][i]) == (adv is not None)
+        if adv is None:
+            continue
+        assert batch["sample"][i] == adv.SampleNumber
+        assert batch["battery"][i] == adv.BatteryPercent
+        assert batch["humidity"][i] == adv.HumidityPercent
+        assert batch["temperature_c"][i] == pytest.approx(adv.TemperatureC)
+        if adv.Weight is None:
+            assert np.isnan(batch["weight"][i])
+        else:
+            assert batch["weight"][i] == pytest.approx(adv.Weight)
+
+
+def test_decode_batch_flat_buffer_with_stride():
+    pytest.importorskip("numpy")
+    stride = ADV_LENGTH + 3
+    batch = decode_batch(b"".join(f.ljust(stride, b"\x00") for f in (V1, V2)), stride=stride)
+    assert list(batch["valid"]) == [True, True]
+    assert list(batch["version_major"]) == [1, 5]
+
+
+def test_decode_bgapi_reads_signed_fields_like_the_original_scanner():
+    frame = (bytes(10) + bytes([43, 10, 9, 19, 59]) + struct.pack("<hh", 600, -20000) + bytes(5) + bytes([0xB2])
+             + bytes([0xFF, 0xDB, 0x3E]) + bytes([0x80, 0x00, 0x01]))
+    adv = decode_bgapi(frame)
+    assert (adv.Model, adv.VersionMajor, adv.VersionMinor, adv.Id, adv.BatteryPercent, adv.SampleNumber) == (43, 9, 10, 19, 59, 600)
+    assert adv.HumidityPercent == -78
+    assert adv.TemperatureF == pytest.approx(-20000 * 315 / (2**16 - 1) - 49)
+    assert adv.WeightL == -9410
+    assert adv.WeightR == 0x800001
+    assert decode_bgapi(frame[:-1]) is None
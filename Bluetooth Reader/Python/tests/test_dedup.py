@@ -0,0 +1,60 @@
+import time
+
+from broodminder.dedup import SampleDedup
+from broodminder.pipeline import SinkPipeline
+from broodminder.reading import BroodMinderResult
+
+
+def test_duplicates_are_skipped_until_they_expire():
+    dedup = SampleDedup(ttl=0.2)
+    assert not dedup.is_duplicate("A", 1)
+    assert dedup.is_duplicate("A", 1)
+    assert not dedup.is_duplicate("B", 1)
+    time.sleep(0.25)
+    assert not dedup.is_duplicate("A", 1)
+    assert dedup.stats()["skipped"] == 1
+
+
+def test_sample_number_wraps_at_16_bits():
+    dedup = SampleDedup()
+    assert not dedup.is_duplicate("A", 0xFFFF)
+    assert dedup.is_duplicate("A", 0x1FFFF)
+    assert not dedup.is_duplicate("A", 0)
+
+
+def test_oldest_entries_are_evicted():
+    dedup = SampleDedup(max_size=2)
+    for sample in range(3):
+        dedup.is_duplicate("A", sample)
+    assert not dedup.is_duplicate("A", 0)
+
+
+def test_failed_send_is_forgotten():
+    dedup = SampleDedup()
+
+    def sink(result):
+        raise OSError("unreachable")
+
+    pipeline = SinkPipeline(sink, dedup=dedup).start()
+    pipeline.submit(BroodMinderResult("A", 1, 20.0, 50, 90))
+    pipeline.close(timeout=5)
+    assert pipeline.failed == 1
+    assert not dedup.is_duplicate("A", 1)
+
+
+def test_dropped_reading_is_forgotten():
+    dedup = SampleDedup()
+    pipeline = SinkPipeline(lambda result: None, max_queued=1, dedup=dedup)  # Not started, so nothing is consumed.
+    pipeline.submit(BroodMinderResult("A", 1, 20.0, 50, 90))
+    pipeline.submit(BroodMinderResult("A", 2, 20.0, 50, 90))
+    assert pipeline.dropped == 1
+    assert not dedup.is_duplicate("A", 1)
+    assert dedup.is_duplicate("A", 2)
+
+
+def test_index_survives_a_restart(tmp_path):
+    path = str(tmp_path / "dedup.json")
+    dedup = SampleDedup(path=path, save_interval=3600)
+    dedup.is_duplicate("A", 1)
+    dedup.close()
+    assert SampleDedup(path=path).is_duplicate("A", 1)
@@ -0,0 +1,58 @@
+import hashlib
+import io
+
+import pytest
+
+from broodminder.delta import OffsetMismatch, UnknownUpload, UploadSessions, read_rows, write_rows
+
+ROWS = [["43:01:02", n, 1600000000 + n * 60, 70.5, 50, 90] for n in range(2000)]
+
+
+def payload(tmp_path):
+    path = str(tmp_path / "payload.ndjson.gz")
+    assert write_rows(path, ROWS, "gzip") == len(ROWS)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_rows_round_trip(tmp_path):
+    path = str(tmp_path / "rows.ndjson.gz")
+    write_rows(path, ROWS, "gzip")
+    chunks = list(read_rows(path, "gzip", chunk_size=500))
+    assert [len(c) for c in chunks] == [500] * 4
+    assert [list(r) for c in chunks for r in c] == ROWS
+
+
+def test_interrupted_upload_resumes_from_the_server_offset(tmp_path):
+    data = payload(tmp_path)
+    sessions = UploadSessions(str(tmp_path))
+    uploadId = sessions.create("gzip")
+    half = len(data) // 2
+    assert sessions.append(uploadId, 0, io.BytesIO(data[:half])) == half
+
+    # The client lost track and tries to send the start again; the server says where it really is.
+    with pytest.raises(OffsetMismatch) as e:
+        sessions.append(uploadId, 0, io.BytesIO(data[:half]))
+    assert e.value.offset == half == sessions.offset(uploadId)
+
+    sessions.append(uploadId, half, io.BytesIO(data[half:]))
+    path, encoding = sessions.finish(uploadId, hashlib.sha256(data).hexdigest())
+    assert [list(r) for c in read_rows(path, encoding) for r in c] == ROWS
+
+
+def test_corrupt_upload_is_refused(tmp_path):
+    data = payload(tmp_path)
+    sessions = UploadSessions(str(tmp_path))
+    uploadId = sessions.create("gzip")
+    sessions.append(uploadId, 0, io.BytesIO(data))
+    with pytest.raises(ValueError):
+        sessions.finish(uploadId, hashlib.sha256(data + b"x").hexdigest())
+
+
+def test_unknown_and_malformed_ids(tmp_path):
+    sessions = UploadSessions(str(tmp_path))
+    for uploadId in ("0" * 32, "../../etc/passwd", None):
+        with pytest.raises(UnknownUpload):
+            sessions.offset(uploadId)
+    with pytest.raises(ValueError):
+        sessions.create("brotli")
@@ -0,0 +1,66 @@
+import threading
+
+from broodminder.influx import BatchWriter, line_protocol, reading_line
+
+
+def test_line_protocol_matches_point_formatting():
+    line = reading_line("43:01:02", 21.0, 50, 90, 7, 1600000000, weight=None)
+    assert line == "broodminder,deviceId=43:01:02 temperature=21,humidity=50i,battery=90i,sampleNumber=7i 1600000000"
+    assert line_protocol("m", {"a b": "c,d"}, {"s": 'say "hi"'}) == 'm,a\\ b=c\\,d s="say \\"hi\\""'
+    assert line_protocol("m", {}, {"x": float("nan"), "y": None}) is None
+
+
+def test_rows_are_written_in_batches():
+    written = []
+    writer = BatchWriter(written.append, batch_size=2, flush_interval=60)
+    writer.add_many(["a", "b", "c", None])
+    stats = writer.close()
+    assert sorted(written) == ["a\nb", "c"]
+    assert stats["rows"] == 3 and stats["batches"] == 2 and stats["failed_rows"] == 0
+
+
+def test_partial_batch_is_flushed_after_the_interval():
+    written = threading.Event()
+    writer = BatchWriter(lambda body: written.set(), batch_size=100, flush_interval=0.1)
+    writer.add("a")
+    assert written.wait(2)
+    writer.close()
+
+
+def test_drain_waits_for_batches_in_flight():
+    release = threading.Event()
+    written = []
+
+    def slow_write(body):
+        release.wait(2)
+        written.append(body)
+
+    writer = BatchWriter(slow_write, batch_size=1, flush_interval=60, max_in_flight=2)
+    writer.add("a")
+    threading.Timer(0.1, release.set).start()
+    writer.drain()
+    assert written == ["a"]
+    writer.close()
+
+
+def test_failed_writes_are_retried_then_counted():
+    attempts = []
+
+    def flaky(body):
+        attempts.append(body)
+        if len(attempts) < 2:
+            raise OSError("503")
+
+    writer = BatchWriter(flaky, batch_size=1, flush_interval=60, retry_interval=0.001)
+    writer.add("a")
+    stats = writer.close()
+    assert stats["rows"] == 1 and stats["retries"] == 1
+
+    def down(body):
+        raise OSError("unreachable")
+
+    writer = BatchWriter(down, batch_size=1, flush_interval=60, max_retries=2, retry_interval=0.001)
+    writer.add("a")
+    stats = writer.close()
+    assert stats["failed_rows"] == 1 and stats["retries"] == 2
+    assert writer.errors == ["unreachable"]
@@ -0,0 +1,59 @@
+import threading
+import time
+
+import pytest
+
+from broodminder.jobs import DONE, FAILED, JobQueue, QueueFull
+
+
+class ImportFailed(Exception):
+    def __init__(self, message, result):
+        super().__init__(message)
+        self.result = result
+
+
+def run(jobs, *args):
+    # Submit a job and wait until the worker is completely done with it.
+    job = jobs.submit(*args)
+    jobs.queue.join()
+    return job
+
+
+def test_job_reports_progress_and_result():
+    def handler(job, value):
+        job.report(rows=value)
+        return value * 2
+
+    jobs = JobQueue(handler, workers=1)
+    job = run(jobs, 21)
+    assert job.status == DONE and job.result == 42
+    assert jobs.get(job.id).to_dict()["progress"] == {"rows": 21}
+    assert job.args is None
+
+
+def test_failed_job_keeps_the_exception_result():
+    def handler(job):
+        raise ImportFailed("no InfluxDB", {"stats": {"rows": 0}})
+
+    job = run(JobQueue(handler, workers=1))
+    assert job.status == FAILED
+    assert job.error == "no InfluxDB" and job.result == {"stats": {"rows": 0}}
+
+
+def test_full_queue_refuses_new_jobs():
+    release = threading.Event()
+    jobs = JobQueue(lambda job: release.wait(5), workers=1, max_queued=1)
+    running = jobs.submit()
+    while running.started is None:
+        time.sleep(0.01)
+    jobs.submit()
+    with pytest.raises(QueueFull):
+        jobs.submit()
+    assert jobs.depth() == 1
+    release.set()
+
+
+def test_only_the_newest_finished_jobs_are_kept():
+    jobs = JobQueue(lambda job: None, workers=1, keep_finished=2)
+    submitted = [run(jobs) for _ in range(4)]
+    assert [jobs.get(j.id) is not None for j in submitted] == [False, False, True, True]
@@ -0,0 +1,91 @@
+import os
+import signal
+import time
+import urllib.request
+
+import pytest
+
+from broodminder.metrics import Profiler, Registry, start_http_server
+
+
+def test_counters_and_gauges_render_with_labels():
+    registry = Registry()
+    sent = registry.counter("bm_sent_total", "Readings sent", ["device"])
+    sent.inc(device='43:01"02')
+    sent.inc(2, device='43:01"02')
+    depth = registry.gauge("bm_depth", "Queue depth")
+    depth.set_function(lambda: 7)
+    assert registry.render() == (
+        "# HELP bm_sent_total Readings sent\n"
+        "# TYPE bm_sent_total counter\n"
+        'bm_sent_total{device="43:01\\"02"} 3\n'
+        "# HELP bm_depth Queue depth\n"
+        "# TYPE bm_depth gauge\n"
+        "bm_depth 7\n")
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    seconds = registry.histogram("bm_seconds", "Time", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        seconds.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:] == ['bm_seconds_bucket{le="0.1"} 1', 'bm_seconds_bucket{le="1.0"} 2', 'bm_seconds_bucket{le="+Inf"} 3',
+                         "bm_seconds_sum 5.55", "bm_seconds_count 3"]
+
+
+def test_registering_twice_returns_the_same_metric():
+    registry = Registry()
+    assert registry.counter("bm_total", "Total") is registry.counter("bm_total", "Total")
+    with pytest.raises(ValueError):
+        registry.gauge("bm_total", "Total")
+    with pytest.raises(ValueError):
+        registry.counter("bm_total", "Total").inc(device="A")
+
+
+def test_registry_is_served_over_http():
+    registry = Registry()
+    registry.counter("bm_total", "Total").inc()
+    server = start_http_server(0, "127.0.0.1", registry)
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(server.server_address[1]), timeout=5) as resp:
+            assert b"bm_total 1" in resp.read()
+    finally:
+        server.shutdown()
+
+
+def wait_for_file(path, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return os.path.exists(path)
+
+
+def test_profiling_window_writes_stats(tmp_path):
+    profiler = Profiler()
+    path = str(tmp_path / "scan.prof")
+    with profiler.section("scan"):
+        pass  # Costs nothing outside a window.
+    assert profiler.start(0.2, path)
+    assert not profiler.start(0.2, path)
+    with profiler.section("scan"):
+        sum(range(10000))
+    assert wait_for_file(path)
+
+
+def test_signal_starts_a_window_while_the_lock_is_held(tmp_path):
+    profiler = Profiler()
+    path = str(tmp_path / "scan.prof")
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        profiler.start_on_signal(signal.SIGUSR1, 0.2, path)
+        with profiler.lock:  # As the main thread does while entering or leaving a section.
+            os.kill(os.getpid(), signal.SIGUSR1)
+        deadline = time.monotonic() + 5
+        while not profiler.active and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with profiler.section("scan"):
+            sum(range(10000))
+        assert wait_for_file(path)
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
@@ -0,0 +1,48 @@
+from broodminder.multiscan import MultiAdapterScanner
+
+
+def reading(hci, rssi, sample=1, deviceId="43:01:02"):
+    return (hci, rssi, deviceId, sample, 21.5, 50, 90, None, 1600000000.0)
+
+
+def merger(hold=2.0, remember=600):
+    # The merge logic only; no worker processes are started.
+    received = []
+    scanner = MultiAdapterScanner([0, 1], lambda *args: received.append(args), hold=hold, remember=remember)
+    return scanner, received
+
+
+def test_strongest_copy_is_handed_on_once():
+    scanner, received = merger()
+    scanner._add(reading(0, -80))
+    scanner._add(reading(1, -60))
+    scanner._add(reading(0, -70))
+    scanner._release(float("inf"))
+    assert received == [("43:01:02", 1, 21.5, 50, 90, None, 1600000000.0, -60)]
+    assert scanner.stats()["merged"] == 2
+
+
+def test_readings_are_held_until_the_hold_time_is_up():
+    scanner, received = merger(hold=60)
+    scanner._add(reading(0, -80))
+    scanner._release(0)
+    assert received == []
+    scanner._release(float("inf"))
+    assert len(received) == 1
+
+
+def test_late_copies_are_dropped():
+    scanner, received = merger()
+    scanner._add(reading(0, -80))
+    scanner._release(float("inf"))
+    scanner._add(reading(1, -50))
+    scanner._release(float("inf"))
+    assert len(received) == 1
+
+
+def test_different_samples_are_kept_apart():
+    scanner, received = merger()
+    scanner._add(reading(0, -80, sample=1))
+    scanner._add(reading(1, -80, sample=2))
+    scanner._release(float("inf"))
+    assert [r[1] for r in received] == [1, 2]
@@ -0,0 +1,37 @@
+import sqlite3
+
+from broodminder.phone_db import open_readonly, stream_readings
+
+
+def phone_db(path, rows, wal=False):
+    db = sqlite3.connect(str(path))
+    if wal:
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA wal_autocheckpoint = 0")
+    db.execute("CREATE TABLE StoredSensorReading (DeviceId TEXT, Sample INTEGER, Timestamp INTEGER, "
+               "Temperature REAL, Humidity INTEGER, Battery INTEGER, Other TEXT)")
+    db.executemany("INSERT INTO StoredSensorReading VALUES (?, ?, ?, ?, ?, ?, 'x')", rows)
+    db.commit()
+    return db
+
+
+def readings(count):
+    return [("43:01:02", i, 1600000000 + i, 70.0 + i, 50, 90) for i in range(count)]
+
+
+def test_stream_reads_every_row_in_chunks(tmp_path):
+    phone_db(tmp_path / "phone.sqlite", readings(7)).close()
+    db = open_readonly(str(tmp_path / "phone.sqlite"))
+    chunks = list(stream_readings(db, chunk_size=3))
+    db.close()
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert [row for chunk in chunks for row in chunk] == readings(7)
+
+
+def test_live_database_is_read_through_its_wal(tmp_path):
+    # The app still has the database open and nothing has been checkpointed yet.
+    app = phone_db(tmp_path / "phone.sqlite", readings(5), wal=True)
+    db = open_readonly(str(tmp_path / "phone.sqlite"), immutable=False)
+    assert sum(len(c) for c in stream_readings(db)) == 5
+    db.close()
+    app.close()
@@ -0,0 +1,46 @@
+import time
+
+from broodminder.query_cache import ALL_DEVICES, QueryCache
+
+
+def test_results_are_cached_until_they_expire():
+    cache = QueryCache(ttl=0.1)
+    loads = []
+    load = lambda: loads.append(1) or len(loads)
+    assert cache.get(("latest", "A"), "A", load) == 1
+    assert cache.get(("latest", "A"), "A", load) == 1
+    time.sleep(0.15)
+    assert cache.get(("latest", "A"), "A", load) == 2
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 2}
+
+
+def test_invalidate_drops_the_device_and_all_device_entries_only():
+    cache = QueryCache()
+    cache.get(("latest", "A"), "A", lambda: "a")
+    cache.get(("latest", "B"), "B", lambda: "b")
+    cache.get(("devices",), ALL_DEVICES, lambda: ["A", "B"])
+    cache.invalidate(["A"])
+    assert set(cache.entries) == {("latest", "B")}
+    cache.invalidate([])
+    assert set(cache.entries) == {("latest", "B")}
+
+
+def test_result_loaded_during_an_invalidation_is_not_cached():
+    cache = QueryCache()
+
+    def slow_load():
+        # An import finishes while the query is running.
+        cache.invalidate(["A"])
+        return "stale"
+
+    assert cache.get(("latest", "A"), "A", slow_load) == "stale"
+    assert cache.get(("latest", "A"), "A", lambda: "fresh") == "fresh"
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = QueryCache(max_entries=2)
+    cache.get("a", "A", lambda: 1)
+    cache.get("b", "B", lambda: 2)
+    cache.get("a", "A", lambda: 1)
+    cache.get("c", "C", lambda: 3)
+    assert list(cache.entries) == ["a", "c"]
@@ -0,0 +1,87 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from broodminder.rollup import RollupBatch, RollupEngine
+
+
+def record(deviceId, start, field, aggregate, value):
+    return dict(deviceId=deviceId, _time=datetime.fromtimestamp(start, timezone.utc), _field=field,
+                aggregate=aggregate, _value=value)
+
+
+class StubQueryApi:
+    # Answers every query with the same records and keeps the queries it was asked.
+    def __init__(self, records=(), error=None):
+        self.records = list(records)
+        self.error = error
+        self.queries = []
+
+    def query_stream(self, query, params=None):
+        self.queries.append((query, params))
+        if self.error is not None:
+            raise self.error
+        return iter(self.records)
+
+
+def test_batch_keys_each_bucket_once():
+    batch = RollupBatch()
+    batch.add(["A", "A", "B"], [3600, 3700, 90000])
+    assert batch.keys == {("1h", "A", 3600), ("1d", "A", 0), ("1h", "B", 90000 - 90000 % 3600), ("1d", "B", 86400)}
+
+
+def test_only_buckets_a_device_has_moved_past_are_complete():
+    batch = RollupBatch()
+    batch.add(["A"], [3600])
+    assert batch.complete() == 0
+    batch.add(["A"], [7200])
+    assert batch.take(complete_only=True) == {("1h", "A", 3600)}
+    assert ("1h", "A", 7200) in batch.keys
+
+
+def test_recompute_writes_one_point_per_bucket():
+    api = StubQueryApi([
+        record("A", 3600, "temperature", "min", 20.0),
+        record("A", 3600, "temperature", "max", 22.5),
+        record("A", 3600, "temperature", "count", 3.0),
+        record("A", 0, "temperature", "min", 19.0),  # Not asked for.
+    ])
+    engine = RollupEngine(api, "bees", intervals=(("1h", 3600),))
+    batch = engine.batch()
+    batch.add(["A"], [3600])
+    written = []
+    assert engine.flush(batch, written.extend) == 1
+    assert written == ["broodminder_1h,deviceId=A temperature_min=20,temperature_max=22.5,temperature_count=3i 3600"]
+    query, params = api.queries[0]
+    assert 'from(bucket: "bees")' in query
+    assert query.count("|> toFloat() |> set(") == 4
+    assert params == {"start": "1970-01-01T01:00:00Z", "stop": "1970-01-01T02:00:00Z", "devices": ["A"]}
+    assert len(batch) == 0
+
+
+def test_long_ranges_are_split_into_several_queries():
+    api = StubQueryApi()
+    engine = RollupEngine(api, "bees", intervals=(("1h", 3600),))
+    batch = engine.batch()
+    batch.add(["A", "A"], [0, 3600 * 24 * 40])
+    engine.flush(batch, lambda lines: None)
+    assert len(api.queries) == 2
+
+
+def test_failed_flush_keeps_the_buckets_for_later():
+    engine = RollupEngine(StubQueryApi(error=OSError("unreachable")), "bees")
+    batch = engine.batch()
+    batch.add(["A"], [3600])
+    with pytest.raises(OSError):
+        engine.flush(batch, lambda lines: None)
+    engine.defer(batch)
+    assert len(batch) == 0 and len(engine.live) == 2
+
+
+def test_live_buckets_survive_a_restart(tmp_path):
+    path = str(tmp_path / "rollups.json")
+    engine = RollupEngine(StubQueryApi(error=OSError("unreachable")), "bees", path=path)
+    engine.touch(["A"], [3600])
+    with pytest.raises(OSError):
+        engine.flush_live(lambda lines: None, force=True)
+    assert RollupEngine(StubQueryApi(), "bees", path=path).live.keys == {("1h", "A", 3600), ("1d", "A", 0)}
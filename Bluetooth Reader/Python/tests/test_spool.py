@@ -0,0 +1,98 @@
+import sqlite3
+
+import pytest
+
+from broodminder.reading import BroodMinderResult
+from broodminder.sinks import RejectedError, Sink
+from broodminder.spool import ReadingSpool, SpoolDrainer
+
+
+def reading(sample):
+    return BroodMinderResult("43:01:02", sample, 21.5, 50, 90, None, 1600000000 + sample)
+
+
+class FlakySink(Sink):
+    def __init__(self, down=(), rejected=()):
+        self.down = set(down)
+        self.rejected = set(rejected)
+        self.sent = []
+
+    def send(self, data):
+        if data.SampleNumber in self.rejected:
+            raise RejectedError("bad reading")
+        if data.SampleNumber in self.down:
+            raise OSError("unreachable")
+        self.sent.append(data.SampleNumber)
+
+
+def spool_of(tmp_path, samples, **kwargs):
+    spool = ReadingSpool(str(tmp_path / "spool.sqlite"), BroodMinderResult, **kwargs)
+    spool.append_many([reading(s) for s in samples])
+    return spool
+
+
+def test_spool_keeps_values_and_order(tmp_path):
+    spool = spool_of(tmp_path, range(3))
+    lastId, readings = spool.peek(10)
+    assert [r.SampleNumber for r in readings] == [0, 1, 2]
+    assert isinstance(readings[0].SampleNumber, int) and isinstance(readings[0].TemperatureC, float)
+    spool.remove(lastId)
+    assert len(spool) == 0
+
+
+def test_spool_drops_oldest_past_max_rows(tmp_path):
+    spool = spool_of(tmp_path, range(5), max_rows=3)
+    assert [r.SampleNumber for r in spool.peek(10)[1]] == [2, 3, 4]
+    assert spool.dropped == 2
+
+
+def test_drainer_replays_backlog(tmp_path):
+    spool = spool_of(tmp_path, range(10))
+    sink = FlakySink()
+    drainer = SpoolDrainer(spool, sink, batch_size=4)
+    while len(spool):
+        assert drainer.drain_once()
+    assert sink.sent == list(range(10))
+    assert drainer.replayed == 10
+
+
+def test_drainer_quarantines_rejected_readings(tmp_path):
+    spool = spool_of(tmp_path, range(5))
+    sink = FlakySink(rejected={0, 3})
+    drainer = SpoolDrainer(spool, sink)
+    assert drainer.drain_once(1)  # The rejected head row doesn't look like an outage...
+    assert drainer.drain_once()
+    assert len(spool) == 0  # ...and doesn't stay in the spool.
+    assert spool.quarantined() == 2
+    assert sink.sent == [1, 2, 4]
+
+
+def test_failing_head_row_moves_to_the_back(tmp_path):
+    spool = spool_of(tmp_path, range(3))
+    sink = FlakySink(down={0})
+    drainer = SpoolDrainer(spool, sink)
+    assert not drainer.drain_once(1)
+    assert [r.SampleNumber for r in spool.peek(10)[1]] == [1, 2, 0]
+    assert drainer.drain_once()
+    assert sink.sent == [1, 2]
+    assert [r.SampleNumber for r in spool.peek(10)[1]] == [0]
+
+
+def test_drainer_leaves_batch_alone_when_sink_is_down(tmp_path):
+    spool = spool_of(tmp_path, range(3))
+    drainer = SpoolDrainer(spool, FlakySink(down={0, 1, 2}))
+    assert not drainer.drain_once()
+    assert [r.SampleNumber for r in spool.peek(10)[1]] == [0, 1, 2]
+
+
+def test_requeue_is_one_transaction(tmp_path):
+    spool = spool_of(tmp_path, range(3))
+    lastId, readings = spool.peek(10)
+    spool.db.execute("CREATE TRIGGER fail BEFORE INSERT ON quarantine BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+    with pytest.raises(sqlite3.IntegrityError):
+        spool.requeue(lastId, failed=readings[:1], rejected=readings[1:2])
+    # Nothing was removed or re-added, and the spool still works.
+    assert [r.SampleNumber for r in spool.peek(10)[1]] == [0, 1, 2]
+    assert len(spool) == 3
+    spool.append(reading(3))
+    assert len(spool) == 4
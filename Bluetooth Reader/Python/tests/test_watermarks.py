@@ -0,0 +1,40 @@
+from broodminder.watermarks import WatermarkLookup, WatermarkStore
+
+
+def test_watermarks_only_move_forward_and_persist(tmp_path):
+    path = str(tmp_path / "watermarks.json")
+    store = WatermarkStore(path)
+    store.update({"A": 100, "B": None})
+    store.update({"A": 50})
+    assert store.all() == {"A": 100.0}
+    assert WatermarkStore(path).get("A") == 100.0
+
+
+def test_unreadable_file_is_ignored(tmp_path):
+    path = tmp_path / "watermarks.json"
+    path.write_text("not json")
+    assert WatermarkStore(str(path)).all() == {}
+
+
+def test_lookup_asks_influxdb_once_and_only_for_unknown_devices(tmp_path):
+    store = WatermarkStore(str(tmp_path / "watermarks.json"))
+    store.update({"A": 100})
+    fetches = []
+
+    def fetch_latest():
+        fetches.append(1)
+        return {"A": 50, "B": 200}
+
+    lookup = WatermarkLookup(store, fetch_latest)
+    assert lookup.get("A") == 100
+    assert fetches == []
+    assert lookup.get_many(["B", "C"]) == {"B": 200, "C": 0}
+    assert lookup.get("D") == 0
+    assert len(fetches) == 1
+    # What InfluxDB knew is kept for the next import.
+    assert store.all() == {"A": 100.0, "B": 200.0}
+
+
+def test_lookup_works_without_a_store():
+    lookup = WatermarkLookup(None, lambda: {"A": 5})
+    assert lookup.get("A") == 5